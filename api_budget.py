@@ -0,0 +1,213 @@
+'''
+Request budget manager for the OpenWeather and NOAA APIs.
+
+Every request goes through ApiBudget.fetch, which
+
+  * serves a cached response while it is younger than the polling interval,
+    so several displays (processes) sharing a cache directory coalesce onto
+    one upstream call,
+  * counts calls per API key against per-minute and per-day quotas, persisted
+    on disk so the count survives cron runs,
+  * stretches the polling interval when the daily quota is running low, and
+  * falls back to the last cached response instead of failing when the quota
+    is used up or the request fails.
+
+Callers that need to know how old the data really is (the snapshot layer)
+wrap their fetch in served(), which collects the fetch time of every
+response fetch() returns on that thread and whether it was a fallback.
+'''
+import datetime as dt
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+from contextlib import contextmanager
+
+import clock
+
+logger = logging.getLogger(__name__)
+
+# OpenWeather's free One Call 3.0 plan allows 1,000 calls a day
+DEFAULT_QUOTAS = {
+    'openweather': {'per_day': 1000, 'per_minute': 60},
+    'noaa': {'per_minute': 60},
+}
+
+
+# Query parameters holding credentials; requests quotes the URL in its errors
+SECRET_PARAMS = ('appid',)
+_SECRET_RE = re.compile(r'\b({})=[^&\s]+'.format('|'.join(SECRET_PARAMS)))
+
+
+class BudgetExhausted(Exception):
+    pass
+
+
+def redact(text):
+    """text (e.g. an error message) with any API keys in it replaced."""
+    return _SECRET_RE.sub(r'\1=REDACTED', str(text))
+
+
+# The responses fetch() returned on this thread inside served()
+_served = threading.local()
+
+
+@contextmanager
+def served():
+    """Yield a list that collects (fetched_at, fell_back) for every response
+    fetch() returns on this thread until the block ends."""
+    outer = getattr(_served, 'responses', None)
+    _served.responses = responses = []
+    try:
+        yield responses
+    finally:
+        _served.responses = outer
+
+
+def _serve(payload, fetched_at, fell_back=False):
+    responses = getattr(_served, 'responses', None)
+    if responses is not None:
+        responses.append((fetched_at, fell_back))
+    return payload
+
+
+def _digest(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:16]
+
+
+@contextmanager
+def _locked(path):
+    with open(path, 'a') as lockfile:
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+
+class ApiBudget:
+    def __init__(self, cache_dir, quotas=None):
+        self.quotas = {name: dict(limits) for name, limits in DEFAULT_QUOTAS.items()}
+        for name, limits in (quotas or {}).items():
+            self.quotas.setdefault(name, {}).update(limits)
+        self.response_dir = os.path.join(cache_dir, 'responses')
+        self.state_path = os.path.join(cache_dir, 'api_budget.json')
+        os.makedirs(self.response_dir, exist_ok=True)
+
+    # Response cache
+
+    def _response_path(self, cache_key):
+        return os.path.join(self.response_dir, _digest(cache_key) + '.json')
+
+    def cached(self, cache_key):
+        """Return (payload, fetched_at) for the last stored response, or (None, None)."""
+        try:
+            with open(self._response_path(cache_key), 'r') as cachefile:
+                entry = json.load(cachefile)
+        except (OSError, ValueError):
+            return None, None
+        return entry['payload'], entry['fetched_at']
+
+    def _store(self, cache_key, payload, fetched_at):
+        path = self._response_path(cache_key)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as cachefile:
+            json.dump({'key': cache_key, 'fetched_at': fetched_at, 'payload': payload}, cachefile)
+        os.replace(tmp_path, path)
+
+    # Quota accounting
+
+    def _update_state(self, update):
+        with _locked(self.state_path + '.lock'):
+            try:
+                with open(self.state_path, 'r') as statefile:
+                    state = json.load(statefile)
+            except (OSError, ValueError):
+                state = {}
+            result = update(state)
+            tmp_path = self.state_path + '.tmp'
+            with open(tmp_path, 'w') as statefile:
+                json.dump(state, statefile)
+            os.replace(tmp_path, self.state_path)
+        return result
+
+    @staticmethod
+    def _usage(state, quota_id, now):
+        usage = state.setdefault(quota_id, {})
+        today = dt.date.fromtimestamp(now).isoformat()
+        minute = int(now // 60)
+        if usage.get('day') != today:
+            usage.update(day=today, day_count=0, consumers=[])
+        if usage.get('minute') != minute:
+            usage.update(minute=minute, minute_count=0)
+        return usage
+
+    def charge(self, quota, api_key, cache_key):
+        """Count one upstream call, or raise BudgetExhausted if none are left."""
+        limits = self.quotas.get(quota, {})
+        quota_id = quota + ':' + _digest(api_key or '')
+
+        def update(state):
+            usage = self._usage(state, quota_id, clock.time())
+            if cache_key not in usage['consumers']:
+                usage['consumers'].append(cache_key)
+            if usage['day_count'] >= limits.get('per_day', float('inf')):
+                raise BudgetExhausted('daily {} quota used up'.format(quota))
+            if usage['minute_count'] >= limits.get('per_minute', float('inf')):
+                raise BudgetExhausted('per-minute {} quota used up'.format(quota))
+            usage['day_count'] += 1
+            usage['minute_count'] += 1
+
+        self._update_state(update)
+
+    def poll_interval(self, quota, api_key, min_interval):
+        """Seconds to wait between calls so the daily quota lasts until midnight,
+        shared between every cache key (display) using the same API key."""
+        limit = self.quotas.get(quota, {}).get('per_day')
+        if limit is None:
+            return min_interval
+        quota_id = quota + ':' + _digest(api_key or '')
+        now = clock.time()
+        usage = self._update_state(lambda state: dict(self._usage(state, quota_id, now)))
+        remaining = limit - usage['day_count']
+        if remaining <= 0:
+            return float('inf')
+        midnight = dt.datetime.combine(dt.date.fromtimestamp(now) + dt.timedelta(days=1), dt.time())
+        seconds_left = midnight.timestamp() - now
+        consumers = max(len(usage['consumers']), 1)
+        return max(min_interval, seconds_left * consumers / remaining)
+
+    # Fetching
+
+    def fetch(self, cache_key, quota, api_key, fetch_fn, min_interval):
+        """Return the payload for cache_key, calling fetch_fn(charge) only when
+        the cached copy is older than the current polling interval.
+
+        fetch_fn must call charge() before every upstream attempt. If the budget
+        is exhausted or fetch_fn fails, the last cached payload is returned
+        (and reported to served() as a fallback); the error is only raised
+        when nothing has been cached yet."""
+        lock_path = self._response_path(cache_key) + '.lock'
+        with _locked(lock_path):
+            # Another display may have fetched while we waited for the lock
+            payload, fetched_at = self.cached(cache_key)
+            interval = self.poll_interval(quota, api_key, min_interval)
+            if payload is not None and clock.time() - fetched_at < interval:
+                return _serve(payload, fetched_at)
+
+            try:
+                payload = fetch_fn(lambda: self.charge(quota, api_key, cache_key))
+            except Exception as error:
+                stale, fetched_at = self.cached(cache_key)
+                if stale is None:
+                    raise
+                logger.warning('%s request failed (%s); using response from %.0fs ago',
+                               quota, redact(error), clock.time() - fetched_at)
+                return _serve(stale, fetched_at, fell_back=True)
+
+            fetched_at = clock.time()
+            self._store(cache_key, payload, fetched_at)
+            return _serve(payload, fetched_at)
@@ -0,0 +1,143 @@
+'''
+Adaptive refresh cadence.
+
+Instead of redrawing every minute, work out when the next refresh is worth
+doing:
+
+  * water level is published every 6 minutes, so wake just after the next
+    publish slot rather than in between,
+  * refresh at that rate while the water is moving fast or near a high/low
+    tide, and back off towards max_interval around slack water,
+  * during quiet hours wake only once per quiet_interval (or when they end),
+  * after a failed fetch retry soon: in retry_interval when there was nothing
+    to draw but the error screen, at the next slot when a source was drawn
+    from its snapshot.
+
+The next wake-up is stored in the display's state directory. A cron run that
+starts before it exits straight away (see due()), so idle ticks cost almost
+nothing.
+'''
+import datetime as dt
+import json
+import logging
+import os
+
+import clock
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'enabled': False,
+    'publish_interval': 360,    # NOAA water level cadence, seconds
+    'publish_lag': 90,          # seconds after a slot before the sample is usually out
+    'min_interval': 360,
+    'max_interval': 1800,       # also keeps the hourly forecast reasonably fresh
+    'turn_window': 2700,        # seconds around a high/low tide to refresh at min_interval
+    'steep_slope': 0.3,         # water level change per hour treated as "moving fast"
+    'quiet_hours': None,        # e.g. ["23:00", "06:00"]
+    'quiet_interval': 3 * 3600,
+    'retry_interval': 30,       # after an error screen
+}
+
+
+def settings(overrides):
+    merged = dict(DEFAULTS)
+    merged.update(overrides or {})
+    return merged
+
+
+def _state_path(state_dir):
+    return os.path.join(state_dir, 'next_wake.json')
+
+
+def stored_wake(state_dir):
+    """Timestamp of the stored next wake-up, or None."""
+    try:
+        with open(_state_path(state_dir), 'r') as statefile:
+            return json.load(statefile)['next_wake']
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def due(state_dir):
+    """True if the stored next wake-up time has passed (or there is none)."""
+    wake = stored_wake(state_dir)
+    return wake is None or clock.time() >= wake
+
+
+def slope_per_hour(water_level, now, window=dt.timedelta(hours=1)):
+    """Least-squares slope of the last hour of water level, in units per hour."""
+    import numpy as np  # not needed by due(), which runs on every tick
+    recent = (water_level.times >= np.datetime64(now - window, 'm')) & np.isfinite(water_level.values)
+    if recent.sum() < 2:
+        return 0.0
+    hours = (water_level.times[recent] - water_level.times[recent][0]) / np.timedelta64(1, 'h')
+    return float(np.polyfit(hours, water_level.values[recent], 1)[0])
+
+
+def seconds_from_turn(hilo, now):
+    """Seconds to the nearest high/low tide, before or after now."""
+    import numpy as np
+    if hilo.size == 0:
+        return None
+    offsets = np.abs(hilo['t'] - np.datetime64(now, 'm')) / np.timedelta64(1, 's')
+    return float(offsets.min())
+
+
+def next_wake(water_level, hilo, overrides=None, now=None, retry=None):
+    """Return (datetime of the next useful refresh, reason).
+
+    retry is 'error' if the frame was an error screen, 'stale' if a source
+    failed and was drawn from its snapshot."""
+    import refresh_policy
+    config = settings(overrides)
+    now = now or clock.now()
+
+    if refresh_policy.in_quiet_hours(config['quiet_hours'], now):
+        end = refresh_policy.parse_hhmm(config['quiet_hours'][1])
+        quiet_end = dt.datetime.combine(now.date(), end)
+        if quiet_end <= now:
+            quiet_end += dt.timedelta(days=1)
+        return min(quiet_end, now + dt.timedelta(seconds=config['quiet_interval'])), 'quiet hours'
+
+    if retry == 'error':
+        return now + dt.timedelta(seconds=config['retry_interval']), 'retrying after an error'
+
+    turn = seconds_from_turn(hilo, now) if hilo is not None else None
+    slope = abs(slope_per_hour(water_level, now)) if water_level is not None else 0.0
+    if retry == 'stale':
+        interval, reason = config['min_interval'], 'retrying stale sources'
+    elif turn is not None and turn <= config['turn_window']:
+        interval, reason = config['min_interval'], 'tide turn {:.0f} min away'.format(turn / 60)
+    else:
+        # Faster water, shorter interval
+        interval = config['min_interval'] * config['steep_slope'] / max(slope, 1e-6)
+        interval = min(max(interval, config['min_interval']), config['max_interval'])
+        reason = 'water level changing {:.2f}/h'.format(slope)
+
+    # Snap to just after the next publish slot at or beyond the interval
+    slot = publish_slot(now.timestamp() + interval, config['publish_interval'], config['publish_lag'])
+    return dt.datetime.fromtimestamp(slot), reason
+
+
+def publish_slot(target, publish_interval=DEFAULTS['publish_interval'], publish_lag=DEFAULTS['publish_lag']):
+    """First timestamp at or after target that is publish_lag seconds past a publish slot."""
+    slot = (target - publish_lag) // publish_interval * publish_interval + publish_lag
+    if slot < target:
+        slot += publish_interval
+    return slot
+
+
+def last_publish_slot(now, publish_interval=DEFAULTS['publish_interval'], publish_lag=DEFAULTS['publish_lag']):
+    """Latest timestamp at or before now that is publish_lag seconds past a publish slot."""
+    return (now - publish_lag) // publish_interval * publish_interval + publish_lag
+
+
+def schedule(state_dir, water_level, hilo, overrides=None, retry=None):
+    """Compute and store the next wake-up; returns it as a datetime."""
+    wake, reason = next_wake(water_level, hilo, overrides, retry=retry)
+    logger.info('Next refresh at %s (%s)', wake.strftime('%H:%M'), reason)
+    os.makedirs(state_dir, exist_ok=True)
+    with open(_state_path(state_dir), 'w') as statefile:
+        json.dump({'next_wake': wake.timestamp(), 'reason': reason}, statefile)
+    return wake
@@ -0,0 +1,141 @@
+'''
+Startup budget check for tide_tracker.py.
+
+Most cron ticks have nothing to do (see cadence.py and
+tide_tracker.cache_drawn), so the path that decides that has to stay
+cheap. This runs a no-op tick in a fresh interpreter with -X importtime and
+fails (exit status 1) if
+
+  * any of the heavy libraries is imported before a refresh is due, or
+  * the tick (importing tide_tracker and deciding there is nothing to do)
+    takes longer than the budget.
+
+The tick runs against a generated config and a cache that already holds
+everything a refresh would fetch (through TIDE_CONFIG and TIDE_CACHE_DIR),
+so config.json doesn't need to be filled in.
+
+    python check_startup.py
+    python check_startup.py --budget-ms 30
+'''
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+script_dir = os.path.dirname(os.path.realpath(__file__))
+
+# Only needed once there is a frame to draw
+HEAVY_MODULES = ('numpy', 'PIL', 'matplotlib', 'requests', 'noaa_coops', 'pandas', 'spidev', 'gpiozero')
+
+DEFAULT_BUDGET_MS = 50
+
+# Without the adaptive cadence, so the tick takes the costlier early exit
+# (tide_tracker.cache_drawn)
+TICK_CONFIG = {
+    'latitude': 42.35,
+    'longitude': -71.05,
+    'noaa_station_id': '8443970',
+    'openweather_api_key': 'check_startup',
+    'dry_run': True,
+}
+
+TICK = '''
+import time
+started = time.perf_counter()
+import tide_config
+import tide_tracker
+due = not tide_tracker.nothing_due(tide_config.get())
+print((time.perf_counter() - started) * 1000, due)
+'''
+
+
+def prepare_tick(directory):
+    """Write TICK_CONFIG and a cache in which every response the display
+    draws is fresh and already drawn, and point the environment at them."""
+    import api_budget
+    import clock
+    import snapshots
+    import sources
+    import tide_config
+
+    config_path = os.path.join(directory, 'config.json')
+    with open(config_path, 'w') as configfile:
+        json.dump(TICK_CONFIG, configfile)
+    os.environ['TIDE_CONFIG'] = config_path
+    os.environ['TIDE_CACHE_DIR'] = os.path.join(directory, 'cache')
+    os.environ.pop('TIDE_DISPLAY', None)
+
+    config = tide_config.load(config_path)
+    budget = api_budget.ApiBudget(config.cache_path)
+    store = snapshots.SnapshotStore(config.state_path)
+    fetched_at = clock.time() - 1  # before the snapshots are written
+    for name, cache_key, _ in sources.cached_responses(config, clock.now()):
+        budget._store(cache_key, {}, fetched_at)
+        store.save(name, None, fetched_at)
+
+
+def parse_importtime(stderr):
+    """Return [(module, depth, self_us, cumulative_us)] from -X importtime
+    output, in the order they were printed (a module after its imports)."""
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        imports.append((name.strip(), depth, int(self_us), int(cumulative_us)))
+    return imports
+
+
+def first_import(imports, module):
+    """Index of the first entry printed while module was being imported."""
+    start = next(i for i, entry in enumerate(imports) if entry[0] == module and entry[1] == 0)
+    while start > 0 and imports[start - 1][1] > 0:
+        start -= 1
+    return start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Check what a no-op tide_tracker tick imports and how long it takes.')
+    parser.add_argument('--budget-ms', type=float, default=DEFAULT_BUDGET_MS,
+                        help='limit for the whole no-op tick (default %(default)s)')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory(prefix='tide_startup_') as directory:
+        prepare_tick(directory)
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', TICK], cwd=script_dir,
+                                capture_output=True, text=True)
+    if result.returncode != 0:
+        print(result.stderr.strip().splitlines()[-1])
+        return 2
+    tick_ms, due = result.stdout.strip().splitlines()[-1].split()
+    if due == 'True':
+        print('The generated cache did not make the tick a no-op (crossed a publish slot?); run again.')
+        return 2
+    imports = parse_importtime(result.stderr)
+    # Everything from tide_config on, including what the checks import lazily
+    imports = imports[first_import(imports, 'tide_config'):]
+    top_level = {name: cumulative_us / 1000.0 for name, depth, _, cumulative_us in imports if depth == 0}
+    tick_ms = float(tick_ms)
+
+    print('no-op tick: {:.1f} ms (budget {:.0f} ms)'.format(tick_ms, args.budget_ms))
+    print('of which importing {}: {:.1f} ms'.format(', '.join(top_level), sum(top_level.values())))
+    slowest = sorted(imports, key=lambda entry: entry[2], reverse=True)[:5]
+    print('slowest imports: ' + ', '.join('{} {:.1f} ms'.format(name, self_us / 1000.0)
+                                          for name, _, self_us, _ in slowest))
+
+    failed = False
+    heavy = sorted(name for name, _, _, _ in imports if name in HEAVY_MODULES)
+    if heavy:
+        print('FAIL: imported before a refresh is due: ' + ', '.join(heavy))
+        failed = True
+    if tick_ms > args.budget_ms:
+        print('FAIL: the no-op tick is over budget')
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
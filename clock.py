@@ -0,0 +1,24 @@
+'''
+Wall clock used by the data and rendering code.
+
+Normally this is just the system clock. Replay and batch rendering set a
+virtual time so a recorded week of data can be rendered in seconds.
+'''
+import datetime as dt
+import time as _time
+
+_virtual = None
+
+
+def set_time(when):
+    """Pin the clock to a datetime (naive local time), or None for real time."""
+    global _virtual
+    _virtual = when
+
+
+def now():
+    return _virtual if _virtual is not None else dt.datetime.now()
+
+
+def time():
+    return _virtual.timestamp() if _virtual is not None else _time.time()
@@ -0,0 +1,35 @@
+'''
+Pixel-aware decimation of time series before charting.
+
+There is no point handing matplotlib more points than the chart has pixel
+columns. minmax() splits the series into one bucket per column and keeps the
+lowest and highest sample of each bucket, so peaks and troughs survive and
+the filled tide curve looks the same as the full-resolution one.
+'''
+import numpy as np
+
+
+def minmax(times, values, width):
+    """Reduce (times, values) to at most 2 * width + 2 points, keeping each
+    bucket's min and max in time order plus the first and last sample, so
+    the curve spans the whole time range. NaN samples are ignored."""
+    count = len(values)
+    if width <= 0 or count <= 2 * width:
+        return times, values
+
+    per_bucket = -(-count // width)  # ceil
+    padded = np.full(per_bucket * width, np.nan)
+    padded[:count] = values
+    buckets = padded.reshape(width, per_bucket)
+
+    # nanargmin/nanargmax raise on all-NaN rows, so mask NaN with +/-inf instead
+    nans = np.isnan(buckets)
+    low = np.argmin(np.where(nans, np.inf, buckets), axis=1)
+    high = np.argmax(np.where(nans, -np.inf, buckets), axis=1)
+
+    offsets = np.arange(width) * per_bucket
+    keep = np.sort(np.stack([low + offsets, high + offsets], axis=1), axis=1).ravel()
+    keep = keep[keep < count]
+    keep = keep[~np.isnan(values[keep])]
+    keep = np.unique(np.concatenate(([0], keep, [count - 1])))
+    return times[keep], values[keep]
@@ -0,0 +1,91 @@
+'''
+Pipelined panel refresh.
+
+A full e-paper refresh blocks in ReadBusy for several seconds. PanelWorker
+moves panel I/O onto its own thread with a single-slot queue, so the next
+fetch/render cycle overlaps the refresh that is still in progress. If a new
+frame arrives before the panel picked up the previous one, the old frame is
+dropped (latest frame wins). submit() returns an event that is set once the
+frame is off the worker's hands: pushed, failed or dropped.
+'''
+import queue
+import threading
+import time
+import traceback
+
+_STOP = object()
+
+
+class PanelWorker:
+    def __init__(self, write_frame, sleep_panel=None):
+        """write_frame(frame) pushes one frame and leaves the panel asleep.
+        sleep_panel() is only called on close if a write failed part way."""
+        self._write_frame = write_frame
+        self._sleep_panel = sleep_panel
+        self._frames = queue.Queue(maxsize=1)
+        self._lock = threading.Lock()
+        self._closed = False
+        self._panel_awake = False
+        self.frames_written = 0
+        self.frames_dropped = 0
+        self._thread = threading.Thread(target=self._run, name='panel-worker', daemon=True)
+        self._thread.start()
+
+    def submit(self, frame):
+        """Queue a frame for the panel, replacing any frame still waiting.
+        Returns a threading.Event that is set when the frame is done with."""
+        done = threading.Event()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('PanelWorker is closed')
+            try:
+                _, superseded = self._frames.get_nowait()
+            except queue.Empty:
+                pass
+            else:
+                superseded.set()
+                self.frames_dropped += 1
+                print('Dropping superseded frame.')
+            self._frames.put_nowait((frame, done))
+        return done
+
+    def close(self, timeout=None):
+        """Let the pending frame finish, stop the worker and make sure the
+        panel is left asleep."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            # Waits behind a pending frame, so the timeout has to cover it too
+            self._frames.put(_STOP, timeout=timeout)
+        except queue.Full:
+            pass  # still stuck in a push; the thread is a daemon
+        else:
+            self._thread.join(None if deadline is None else max(deadline - time.monotonic(), 0))
+        if self._panel_awake and self._sleep_panel is not None:
+            try:
+                self._sleep_panel()
+            except Exception:
+                traceback.print_exc()
+            self._panel_awake = False
+
+    def _run(self):
+        while True:
+            item = self._frames.get()
+            if item is _STOP:
+                return
+            frame, done = item
+            self._panel_awake = True
+            try:
+                self._write_frame(frame)
+            except Exception:
+                print('Error writing frame to panel.')
+                traceback.print_exc()
+                continue
+            else:
+                self._panel_awake = False
+                self.frames_written += 1
+            finally:
+                done.set()
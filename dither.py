@@ -0,0 +1,122 @@
+'''
+Explicit 1-bit conversion for icons and charts.
+
+Pasting a colour or grey image into the mode '1' frame makes PIL convert it
+implicitly (Floyd-Steinberg), which looks uneven on the icons and costs time
+we don't control. Everything drawn on the frame goes through convert()
+instead, with one of:
+
+  threshold  light where grey >= level; crisp for line art and the chart
+  bayer      ordered dithering with a 4x4 Bayer matrix (2x2 or 8x8 with
+             bayer_size)
+  diffuse    error diffusion, swept one column at a time so every step is a
+             NumPy operation over all rows; the error of each pixel goes to
+             the three neighbours in the next column (1/4, 1/2, 1/4)
+
+All three use integer arithmetic only, so the same input always gives the
+same bytes on every machine and the frame hash / diff logic can rely on it.
+
+    python dither.py    # time each method on the icons and a full frame
+'''
+import time
+
+import numpy as np
+from PIL import Image
+
+METHODS = ('threshold', 'bayer', 'diffuse')
+BAYER_SIZES = (2, 4, 8)
+
+
+def gray(image):
+    """Return image as a uint8 array, transparent areas flattened onto white."""
+    if image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info:
+        image = image.convert('RGBA')
+        image = Image.alpha_composite(Image.new('RGBA', image.size, (255, 255, 255, 255)), image)
+    return np.asarray(image.convert('L'))
+
+
+def threshold(levels, level=128):
+    """Boolean array, True where the pixel is light (white)."""
+    return levels >= level
+
+
+def bayer_matrix(size=4):
+    matrix = np.zeros((1, 1), dtype=np.int32)
+    while matrix.shape[0] < size:
+        matrix = np.block([[4 * matrix, 4 * matrix + 2], [4 * matrix + 3, 4 * matrix + 1]])
+    return matrix
+
+
+def bayer(levels, size=4):
+    if size not in BAYER_SIZES:
+        raise ValueError('unknown Bayer matrix size {!r}, expected one of {}'.format(
+            size, ', '.join(map(str, BAYER_SIZES))))
+    matrix = bayer_matrix(size)
+    cells = size * size
+    height, width = levels.shape
+    tiled = np.tile(matrix, (-(-height // size), -(-width // size)))[:height, :width]
+    # light where levels / 256 > (m + 0.5) / cells, kept in integers
+    return levels.astype(np.int32) * cells * 2 >= (2 * tiled + 1) * 256
+
+
+def diffuse(levels):
+    height, width = levels.shape
+    light = np.empty((height, width), dtype=bool)
+    error = np.zeros(height + 2, dtype=np.int32)  # padded by one row on each side
+    for x in range(width):
+        column = levels[:, x].astype(np.int32) + error[1:-1]
+        light[:, x] = column >= 128
+        residual = column - np.where(light[:, x], 255, 0)
+        quarter = residual >> 2  # floor division, also for negative residuals
+        error[:] = 0
+        error[1:-1] += residual - 2 * quarter
+        error[:-2] += quarter
+        error[2:] += quarter
+    return light
+
+
+def dither_array(levels, method='threshold', bayer_size=4):
+    if method == 'threshold':
+        return threshold(levels)
+    if method == 'bayer':
+        return bayer(levels, bayer_size)
+    if method == 'diffuse':
+        return diffuse(levels)
+    raise ValueError('unknown dither method {!r}, expected one of {}'.format(method, ', '.join(METHODS)))
+
+
+def convert(image, method='threshold', size=None, bayer_size=4):
+    """Convert a PIL image to mode '1' with the given method, resizing the
+    flattened grey image to size first if given. bayer_size is the Bayer
+    matrix size for method 'bayer'."""
+    if image.mode == '1' and size in (None, image.size):
+        return image
+    levels = gray(image)
+    if size is not None and size != image.size:
+        levels = np.asarray(Image.fromarray(levels).resize(size, Image.LANCZOS))
+    return Image.fromarray(dither_array(levels, method, bayer_size))
+
+
+def main():
+    import glob
+    import os
+
+    icons = [Image.open(path)
+             for path in sorted(glob.glob(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'images', 'icon', '*.png')))]
+    ramp = Image.fromarray(np.tile(np.linspace(0, 255, 800).astype(np.uint8), (480, 1)))
+    variants = [(method, 4) for method in METHODS if method != 'bayer']
+    variants[1:1] = [('bayer', bayer_size) for bayer_size in BAYER_SIZES]
+    for method, bayer_size in variants:
+        label = method if method != 'bayer' else 'bayer{}'.format(bayer_size)
+        started = time.perf_counter()
+        for icon in icons:
+            convert(icon, method, (130, 130), bayer_size)
+        icon_ms = (time.perf_counter() - started) * 1000 / max(len(icons), 1)
+        started = time.perf_counter()
+        convert(ramp, method, bayer_size=bayer_size)
+        frame_ms = (time.perf_counter() - started) * 1000
+        print('{:10s} {:7.2f} ms per icon  {:7.2f} ms per 800x480 frame'.format(label, icon_ms, frame_ms))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+'''
+Helpers for packed 1-bit EPD frames.
+
+A packed frame is the buffer EPD.display consumes: one bit per pixel, rows of
+width/8 bytes, 1 = black (the inverse of PIL's mode '1').
+'''
+import numpy as np
+
+import dither
+
+EPD_WIDTH = 800
+EPD_HEIGHT = 480
+ROW_BYTES = EPD_WIDTH // 8
+FRAME_BYTES = ROW_BYTES * EPD_HEIGHT
+
+
+def pack(image):
+    """Pack a PIL image into the driver's buffer layout (same bytes as EPD.getbuffer)."""
+    image = dither.convert(image)
+    buf = np.frombuffer(image.tobytes('raw'), dtype=np.uint8) ^ 0xFF
+    return bytearray(buf.tobytes())
+
+
+def as_rows(frame, row_bytes=ROW_BYTES):
+    return np.frombuffer(bytes(frame), dtype=np.uint8).reshape(-1, row_bytes)
+
+
+def changed_pixels(prev, frame):
+    """Number of pixels that differ between two packed frames."""
+    diff = np.frombuffer(bytes(prev), dtype=np.uint8) ^ np.frombuffer(bytes(frame), dtype=np.uint8)
+    return int(np.unpackbits(diff).sum())
+
+
+def changed_row_span(prev, frame, row_bytes=ROW_BYTES):
+    """Return (first_row, end_row) bounding every changed row, or None if equal."""
+    rows = np.flatnonzero(np.any(as_rows(prev, row_bytes) != as_rows(frame, row_bytes), axis=1))
+    if rows.size == 0:
+        return None
+    return int(rows[0]), int(rows[-1]) + 1
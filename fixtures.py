@@ -0,0 +1,142 @@
+'''
+Record/replay of OpenWeather and NOAA responses.
+
+record  every upstream response is also written to the fixture directory,
+        one JSON file per response, named by the millisecond it was recorded.
+replay  nothing goes to the network. Requests are answered from the fixture
+        directory, optionally with added latency and a random error rate.
+        The recording closest to (but not after) the current clock time is
+        used, and with time_shift its timestamps are moved to "now", so a
+        single recording, or a recorded week, can be replayed at any time.
+
+Enable with a "fixtures" block in config.json, e.g.
+
+    "fixtures": {"mode": "replay", "dir": "fixtures", "latency_ms": 200,
+                 "error_rate": 0.05, "seed": 1, "time_shift": true}
+
+or by setting TIDE_FIXTURES=record|replay in the environment.
+'''
+import bisect
+import hashlib
+import json
+import os
+import random
+import time
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+import numpy as np
+import requests
+
+import clock
+
+# Query parameters that change between otherwise identical requests
+VOLATILE_PARAMS = {'begin_date', 'end_date', 'appid', 'application'}
+SECRET_PARAMS = {'appid'}
+# OpenWeather fields holding unix timestamps
+OPENWEATHER_TIME_FIELDS = ('dt', 'sunrise', 'sunset', 'moonrise', 'moonset', 'start', 'end')
+
+mode = None
+fixture_dir = 'fixtures'
+latency_ms = 0
+error_rate = 0.0
+time_shift = True
+_random = random.Random()
+
+
+def configure(settings, base_dir):
+    global mode, fixture_dir, latency_ms, error_rate, time_shift
+    settings = settings or {}
+    mode = os.environ.get('TIDE_FIXTURES', settings.get('mode')) or None
+    fixture_dir = os.path.join(base_dir, settings.get('dir', 'fixtures'))
+    latency_ms = settings.get('latency_ms', 0)
+    error_rate = settings.get('error_rate', 0.0)
+    time_shift = settings.get('time_shift', True)
+    _random.seed(settings.get('seed'))
+
+
+def fixture_key(url):
+    """Identify a request independent of its date range and credentials."""
+    parts = urlsplit(url)
+    params = sorted((k, v) for k, v in parse_qsl(parts.query) if k not in VOLATILE_PARAMS)
+    name = parts.netloc + parts.path + '?' + urlencode(params)
+    return hashlib.sha1(name.encode('utf-8')).hexdigest()[:16]
+
+
+def _redact(url):
+    parts = urlsplit(url)
+    params = [(k, 'REDACTED' if k in SECRET_PARAMS else v) for k, v in parse_qsl(parts.query)]
+    return parts._replace(query=urlencode(params)).geturl()
+
+
+def record(url, response):
+    recorded_at = clock.time()
+    directory = os.path.join(fixture_dir, fixture_key(url))
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, '{:.0f}.json'.format(recorded_at * 1000)), 'w') as fixturefile:
+        json.dump({'url': _redact(url), 'recorded_at': recorded_at,
+                   'status': response.status_code, 'body': response.text}, fixturefile)
+
+
+def _recordings(url):
+    directory = os.path.join(fixture_dir, fixture_key(url))
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return directory, []
+    return directory, sorted(int(name[:-5]) for name in names if name.endswith('.json'))
+
+
+def _shift_noaa(rows, seconds):
+    # Whole 6-minute steps, so the series stays on NOAA's publishing grid
+    times = np.array([row['t'] for row in rows], dtype='datetime64[m]')
+    times = times + np.timedelta64(6 * round(seconds / 360), 'm')
+    for row, text in zip(rows, np.datetime_as_string(times, unit='m')):
+        row['t'] = text.replace('T', ' ')
+
+
+def _shift_openweather(entry, seconds):
+    for field in OPENWEATHER_TIME_FIELDS:
+        if isinstance(entry.get(field), (int, float)):
+            entry[field] += int(seconds)
+
+
+def shift_payload(payload, seconds):
+    """Move every timestamp in a NOAA or OpenWeather payload by seconds."""
+    for key in ('data', 'predictions'):
+        if payload.get(key):
+            _shift_noaa(payload[key], seconds)
+    if 'current' in payload:
+        _shift_openweather(payload['current'], seconds)
+    for key in ('hourly', 'daily', 'alerts'):
+        for entry in payload.get(key, []):
+            _shift_openweather(entry, seconds)
+    return payload
+
+
+def _response(url, status, body):
+    response = requests.Response()
+    response.url = url
+    response.status_code = status
+    response._content = body.encode('utf-8')
+    response.encoding = 'utf-8'
+    return response
+
+
+def replay(url):
+    if latency_ms:
+        time.sleep(latency_ms / 1000.0)
+    if error_rate and _random.random() < error_rate:
+        return _response(url, 503, '{"error": "injected by fixture replay"}')
+
+    directory, recorded = _recordings(url)
+    if not recorded:
+        raise requests.ConnectionError('no fixture recorded for ' + _redact(url))
+    now = clock.time()
+    index = max(bisect.bisect_right(recorded, now * 1000) - 1, 0)
+    with open(os.path.join(directory, '{}.json'.format(recorded[index]))) as fixturefile:
+        fixture = json.load(fixturefile)
+
+    body = fixture['body']
+    if time_shift and fixture['status'] == 200:
+        body = json.dumps(shift_payload(json.loads(body), now - fixture['recorded_at']))
+    return _response(url, fixture['status'], body)
@@ -0,0 +1,265 @@
+'''
+Fleet poller: keeps the shared caches fresh for many displays.
+
+A central deployment renders many displays from one cache directory. Rather
+than every renderer fetching on its own schedule, this service polls each
+distinct station and location once, on that source's own cadence, through
+the weather_tides_api functions. The results land in the response cache
+(and the tide archive) the renderers read, so their own fetches are cache
+hits.
+
+  * Sources come from every display profile in config.json, plus an
+    optional fleet file: {"stations": ["8443970", ...],
+    "locations": [{"latitude": 42.35, "longitude": -71.05, "units": "imperial"}, ...]}.
+    Each station and each location/units pair is polled once, however
+    many displays show it.
+  * Water level is polled just after each 6-minute publish slot, high/low
+    predictions every 6 hours, weather every 10 minutes.
+  * asyncio schedules the polls; the blocking calls run on a small thread
+    pool behind a per-host limit on concurrent requests and on request
+    spacing, derived from the per-minute quota in api_budget. The daily
+    quotas are still enforced by api_budget itself.
+  * Requests share weather_tides_api.session, so connections are kept alive.
+  * Every report_interval seconds it logs and writes cache/fleet_status.json
+    with each source's data age (from the response cache), last latency,
+    poll and failure counts. A poll that api_budget answered with its stale
+    fallback counts as a failure.
+
+    python fleet_poller.py --fleet fleet.json
+    python fleet_poller.py --once            # poll everything once and report
+'''
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import api_budget
+import cadence
+import clock
+from sources import HILO_MIN_INTERVAL, WEATHER_MIN_INTERVAL
+import tide_config
+import weather_tides_api
+
+logger = logging.getLogger(__name__)
+
+# Concurrent requests per upstream host
+HOST_CONCURRENCY = {'noaa': 4, 'openweather': 4}
+REPORT_INTERVAL = 60
+
+
+class HostLimiter:
+    """At most `concurrency` requests in flight, started at least `spacing` seconds apart."""
+
+    def __init__(self, concurrency, per_minute=None):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.spacing = 60.0 / per_minute if per_minute else 0.0
+        self.next_start = 0.0
+
+    async def __aenter__(self):
+        await self.semaphore.acquire()
+        now = time.monotonic()
+        start = max(now, self.next_start)
+        self.next_start = start + self.spacing
+        if start > now:
+            await asyncio.sleep(start - now)
+
+    async def __aexit__(self, *exc_info):
+        self.semaphore.release()
+
+
+class Source:
+    """One deduplicated thing to poll, with its schedule and statistics."""
+
+    def __init__(self, name, kind, host, fetch, interval, aligned=False):
+        self.name = name
+        self.kind = kind
+        self.host = host
+        self.fetch = fetch
+        self.interval = interval
+        self.aligned = aligned  # poll just after NOAA's publish slots
+        self.next_due = 0.0
+        self.running = False
+        self.fetched_at = None  # when the newest data we have was fetched upstream
+        self.latency = None
+        self.polls = 0
+        self.failures = 0
+        self.last_error = None
+
+    def schedule(self, now):
+        if self.aligned:
+            self.next_due = cadence.publish_slot(now + 1, self.interval)
+        else:
+            self.next_due = now + self.interval
+
+    def status(self, now):
+        return {
+            'source': self.name,
+            'kind': self.kind,
+            'age': None if self.fetched_at is None else round(now - self.fetched_at, 1),
+            'latency': None if self.latency is None else round(self.latency, 3),
+            'polls': self.polls,
+            'failures': self.failures,
+            'next_in': round(self.next_due - now, 1),
+            'last_error': self.last_error,
+        }
+
+
+def load_sources(fleet_path=None):
+    """Build the deduplicated sources from the display profiles and the fleet file."""
+    configs = list(tide_config.profiles().values())
+    default = tide_config.get()
+    stations = {config.noaa_station_id for config in configs}
+    locations = {(config.latitude, config.longitude, config.units, config.openweather_api_key)
+                 for config in configs}
+    if fleet_path:
+        with open(fleet_path, 'r') as fleetfile:
+            fleet = json.load(fleetfile)
+        stations.update(str(station) for station in fleet.get('stations', []))
+        for location in fleet.get('locations', []):
+            locations.add((float(location['latitude']), float(location['longitude']),
+                           location.get('units', default.units),
+                           location.get('openweather_api_key', default.openweather_api_key)))
+
+    sources = []
+    for station in sorted(stations):
+        sources.append(Source(station, 'water_level', 'noaa',
+                              lambda station=station: weather_tides_api.water_level_24h(station),
+                              cadence.DEFAULTS['publish_interval'], aligned=True))
+        sources.append(Source(station, 'hilo', 'noaa',
+                              lambda station=station: weather_tides_api.tides(station),
+                              HILO_MIN_INTERVAL))
+    for latitude, longitude, units, api_key in sorted(locations):
+        sources.append(Source('{},{} {}'.format(latitude, longitude, units), 'weather', 'openweather',
+                              lambda location=(latitude, longitude, units, api_key):
+                                  weather_tides_api.onecall(*location),
+                              WEATHER_MIN_INTERVAL))
+    # Spread the first polls of each kind over its interval instead of starting them all at once
+    now = clock.time()
+    for kind in ('hilo', 'weather'):
+        group = [source for source in sources if source.kind == kind]
+        for index, source in enumerate(group):
+            source.next_due = now + source.interval * index / len(group) if index else now
+    return sources
+
+
+def mount_session(concurrency):
+    # Enough pooled keep-alive connections per host for the concurrency limit
+    adapter = requests.adapters.HTTPAdapter(pool_connections=len(concurrency),
+                                            pool_maxsize=max(concurrency.values()))
+    weather_tides_api.session.mount('https://', adapter)
+
+
+def fetch_served(fetch):
+    """Run fetch and return the (fetched_at, fell_back) of every response
+    api_budget served it."""
+    with api_budget.served() as responses:
+        fetch()
+    return responses
+
+
+async def poll(source, limiter):
+    source.running = True
+    try:
+        async with limiter:
+            started = time.monotonic()
+            try:
+                responses = await asyncio.to_thread(fetch_served, source.fetch)
+                if responses:
+                    source.fetched_at = min(fetched_at for fetched_at, _ in responses)
+                else:
+                    source.fetched_at = clock.time()
+                if any(fell_back for _, fell_back in responses):
+                    source.failures += 1
+                    source.last_error = 'request failed, serving the cached response'
+                else:
+                    source.last_error = None
+            except Exception as error:
+                source.failures += 1
+                # requests errors quote the URL, OpenWeather key included
+                source.last_error = api_budget.redact(error)
+                logger.warning('%s %s failed: %s', source.kind, source.name, source.last_error)
+            source.latency = time.monotonic() - started
+            source.polls += 1
+    finally:
+        source.schedule(clock.time())
+        source.running = False
+
+
+def report(sources, status_path):
+    now = clock.time()
+    statuses = [source.status(now) for source in sources]
+    ages = [status['age'] for status in statuses if status['age'] is not None]
+    latencies = [status['latency'] for status in statuses if status['latency'] is not None]
+    logger.info('%d sources, %d with data; oldest data %.0fs; latency max %.2fs; %d failures',
+                len(statuses), len(ages), max(ages, default=0), max(latencies, default=0),
+                sum(status['failures'] for status in statuses))
+    for status in statuses:
+        logger.debug('%(kind)-11s %(source)-28s age %(age)ss latency %(latency)ss '
+                     'polls %(polls)d failures %(failures)d', status)
+    tmp_path = status_path + '.tmp'
+    with open(tmp_path, 'w') as statusfile:
+        json.dump({'time': now, 'sources': statuses}, statusfile, indent=1)
+    os.replace(tmp_path, status_path)
+    return statuses
+
+
+async def run(sources, concurrency, report_interval, once=False):
+    budget = weather_tides_api.budget
+    limiters = {host: HostLimiter(limit, budget.quotas.get(host, {}).get('per_minute'))
+                for host, limit in concurrency.items()}
+    # The blocking fetches only wait on the network, so one thread per allowed request
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(sum(concurrency.values())))
+    status_path = os.path.join(tide_config.get().cache_path, 'fleet_status.json')
+
+    if once:
+        await asyncio.gather(*(poll(source, limiters[source.host]) for source in sources))
+        return report(sources, status_path)
+
+    tasks = set()
+    next_report = time.monotonic() + report_interval
+    while True:
+        now = clock.time()
+        for source in sources:
+            if not source.running and source.next_due <= now:
+                task = asyncio.create_task(poll(source, limiters[source.host]))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        if time.monotonic() >= next_report:
+            report(sources, status_path)
+            next_report += report_interval
+        waiting = [source.next_due for source in sources if not source.running]
+        await asyncio.sleep(min(max(min(waiting, default=now + 1) - now, 0.05), 1.0))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Poll every station and location the displays use.')
+    parser.add_argument('--fleet', help='JSON file with extra "stations" and "locations"')
+    parser.add_argument('--once', action='store_true', help='poll every source once, report and exit')
+    parser.add_argument('--report-interval', type=float, default=REPORT_INTERVAL)
+    parser.add_argument('--noaa-concurrency', type=int, default=HOST_CONCURRENCY['noaa'])
+    parser.add_argument('--openweather-concurrency', type=int, default=HOST_CONCURRENCY['openweather'])
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    concurrency = {'noaa': args.noaa_concurrency, 'openweather': args.openweather_concurrency}
+    sources = load_sources(args.fleet)
+    logger.info('Polling %d stations and %d locations',
+                sum(source.kind == 'water_level' for source in sources),
+                sum(source.kind == 'weather' for source in sources))
+    mount_session(concurrency)
+    try:
+        asyncio.run(run(sources, concurrency, args.report_interval, args.once))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s: %(message)s')
+    main()
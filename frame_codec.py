@@ -0,0 +1,278 @@
+'''
+Delta-encoded frame wire format for panels on slow links.
+
+A packed frame is 48,000 bytes, but an update usually changes a few rows
+(the clock, a temperature, the end of the tide curve). Each message carries
+either a keyframe or the XOR of the changed row bands against the previous
+frame, zlib-compressed. Bands are full-width row ranges, the window that
+panel_driver.push_frame hands to display_Partial.
+
+Message layout (little endian):
+
+    header   magic 'TDLT', version u8, kind u8 (0 key, 1 delta), mode u8,
+             pad u8, sequence u32, base sequence u32, frame length u32,
+             crc32 of the resulting frame u32, payload length u32,
+             band count u16
+    bands    band count x (first row, end row) u16
+    payload  zlib stream of the band rows, in order: the frame bytes for a
+             keyframe, frame XOR previous frame for a delta
+
+Decoder.feed() accepts the stream in pieces of any size, as they arrive
+from a socket, and decompresses and applies each piece straight into the
+frame buffer that is then given to the driver. A delta whose base isn't the
+frame the decoder holds is skipped until the next keyframe; the encoder
+sends one every keyframe_interval messages and after a reconnect.
+
+Only the standard library is used so the driver process stays small.
+
+    python frame_codec.py frames/    # benchmark on render_batch --format epd output
+'''
+import argparse
+import glob
+import os
+import socket
+import struct
+import time
+import zlib
+from collections import namedtuple
+
+import frame_shm
+
+
+MAGIC = b'TDLT'
+VERSION = 1
+HEADER = struct.Struct('<4sBBBxIIIIIH')
+BAND = struct.Struct('<HH')
+KEY, DELTA = 0, 1
+
+ROW_BYTES = 100  # 800 pixels wide
+MERGE_GAP = 4  # unchanged rows between bands cheaper to resend than to start a new band
+DEFAULT_KEYFRAME_INTERVAL = 60
+
+# rows is the (first, end) span of the changed bands, None for a keyframe.
+# frame is the decoder's buffer, valid until the next feed().
+Update = namedtuple('Update', ['sequence', 'mode', 'rows', 'frame'])
+
+
+class FrameCodecError(Exception):
+    pass
+
+
+def _xor(a, b):
+    return (int.from_bytes(a, 'little') ^ int.from_bytes(b, 'little')).to_bytes(len(a), 'little')
+
+
+def changed_bands(prev, frame, row_bytes=ROW_BYTES, merge_gap=MERGE_GAP):
+    """Return [(first_row, end_row)] covering every row that differs."""
+    prev, frame = memoryview(prev), memoryview(frame)
+    bands = []
+    for row in range(len(frame) // row_bytes):
+        start = row * row_bytes
+        if prev[start:start + row_bytes] != frame[start:start + row_bytes]:
+            if bands and row - bands[-1][1] <= merge_gap:
+                bands[-1][1] = row + 1
+            else:
+                bands.append([row, row + 1])
+    return [tuple(band) for band in bands]
+
+
+class Encoder:
+    def __init__(self, row_bytes=ROW_BYTES, keyframe_interval=DEFAULT_KEYFRAME_INTERVAL, level=6):
+        self.row_bytes = row_bytes
+        self.keyframe_interval = keyframe_interval
+        self.level = level
+        self.sequence = 0
+        self.reset()
+
+    def reset(self):
+        """Make the next message a keyframe (e.g. after a reconnect)."""
+        self.prev = None
+        self.since_key = 0
+
+    def encode(self, frame, mode='full'):
+        """Return the message for frame; mode is the refresh mode the panel should use."""
+        frame = bytes(frame)
+        self.sequence = (self.sequence + 1) & 0xFFFFFFFF
+        base = self.sequence - 1 & 0xFFFFFFFF
+        message = None
+        if self.prev is not None and len(self.prev) == len(frame) and self.since_key < self.keyframe_interval:
+            bands = changed_bands(self.prev, frame, self.row_bytes)
+            payload = zlib.compress(b''.join(
+                _xor(self.prev[first * self.row_bytes:end * self.row_bytes],
+                     frame[first * self.row_bytes:end * self.row_bytes]) for first, end in bands), self.level)
+            message = self._message(DELTA, mode, base, frame, bands, payload)
+            self.since_key += 1
+        key = self._message(KEY, mode, 0, frame, [(0, len(frame) // self.row_bytes)], zlib.compress(frame, self.level))
+        if message is None or len(key) <= len(message):
+            message = key
+            self.since_key = 0
+        self.prev = frame
+        return message
+
+    def _message(self, kind, mode, base, frame, bands, payload):
+        header = HEADER.pack(MAGIC, VERSION, kind, frame_shm.MODES.index(mode), self.sequence, base,
+                             len(frame), zlib.crc32(frame), len(payload), len(bands))
+        return header + b''.join(BAND.pack(*band) for band in bands) + payload
+
+
+class Decoder:
+    def __init__(self, frame_bytes, row_bytes=ROW_BYTES):
+        self.frame = bytearray(frame_bytes)  # handed to EPD.display as is
+        self.row_bytes = row_bytes
+        self.sequence = None  # sequence of the frame in self.frame, None until a keyframe
+        self.skipped = 0
+        self._pending = b''
+        self._message = None
+
+    def feed(self, data):
+        """Consume received bytes; returns the list of completed Updates."""
+        updates = []
+        self._pending += data
+        while True:
+            if self._message is None and not self._start_message():
+                return updates
+            if not self._continue_message():
+                return updates
+            update = self._finish_message()
+            if update is not None:
+                updates.append(update)
+
+    def _start_message(self):
+        if len(self._pending) < HEADER.size:
+            return False
+        magic, version, kind, mode, sequence, base, length, crc, payload_len, count = HEADER.unpack_from(self._pending)
+        if magic != MAGIC or version != VERSION:
+            raise FrameCodecError('not a frame message (magic {!r}, version {})'.format(magic, version))
+        if len(self._pending) < HEADER.size + count * BAND.size:
+            return False
+        bands = [BAND.unpack_from(self._pending, HEADER.size + i * BAND.size) for i in range(count)]
+        self._pending = self._pending[HEADER.size + count * BAND.size:]
+        if length != len(self.frame):
+            raise FrameCodecError('frame is {} bytes, expected {}'.format(length, len(self.frame)))
+        skip = kind == DELTA and base != self.sequence
+        if skip:
+            self.skipped += 1
+            self.sequence = None  # our frame is behind; wait for a keyframe
+        self._message = {
+            'kind': kind, 'mode': frame_shm.MODES[mode], 'sequence': sequence, 'crc': crc,
+            'remaining': payload_len, 'bands': bands, 'skip': skip,
+            'inflate': zlib.decompressobj(), 'band': 0, 'offset': 0,
+        }
+        return True
+
+    def _continue_message(self):
+        message = self._message
+        take = min(message['remaining'], len(self._pending))
+        piece, self._pending = self._pending[:take], self._pending[take:]
+        message['remaining'] -= take
+        if not message['skip']:
+            self._apply(message['inflate'].decompress(piece))
+            if message['remaining'] == 0:
+                self._apply(message['inflate'].flush())
+        return message['remaining'] == 0
+
+    def _apply(self, data):
+        # Write decompressed band bytes into the frame, across band boundaries
+        message = self._message
+        while data:
+            if message['band'] == len(message['bands']):
+                raise FrameCodecError('frame {} has more data than its bands'.format(message['sequence']))
+            first, end = message['bands'][message['band']]
+            start = first * self.row_bytes + message['offset']
+            size = min(len(data), end * self.row_bytes - start)
+            if message['kind'] == KEY:
+                self.frame[start:start + size] = data[:size]
+            else:
+                self.frame[start:start + size] = _xor(self.frame[start:start + size], data[:size])
+            data = data[size:]
+            message['offset'] += size
+            if first * self.row_bytes + message['offset'] == end * self.row_bytes:
+                message['band'] += 1
+                message['offset'] = 0
+
+    def _finish_message(self):
+        message, self._message = self._message, None
+        if message['skip']:
+            return None
+        if zlib.crc32(self.frame) != message['crc']:
+            self.sequence = None
+            raise FrameCodecError('frame {} failed its checksum'.format(message['sequence']))
+        self.sequence = message['sequence']
+        rows = None
+        if message['kind'] == DELTA:
+            rows = (message['bands'][0][0], message['bands'][-1][1]) if message['bands'] else (0, 0)
+        return Update(message['sequence'], message['mode'], rows, self.frame)
+
+
+class FrameSender:
+    """Sends encoded frames to a remote panel_driver over TCP, reconnecting as needed."""
+
+    def __init__(self, address, keyframe_interval=DEFAULT_KEYFRAME_INTERVAL, timeout=30):
+        host, port = address.rsplit(':', 1)
+        self.address = (host, int(port))
+        self.timeout = timeout
+        self.encoder = Encoder(keyframe_interval=keyframe_interval)
+        self.sock = None
+
+    def send(self, frame, mode):
+        """Send one frame; returns the message size. Raises OSError if the link is down."""
+        try:
+            if self.sock is None:
+                self.sock = socket.create_connection(self.address, timeout=self.timeout)
+                self.encoder.reset()
+            message = self.encoder.encode(frame, mode)
+            self.sock.sendall(message)
+            return len(message)
+        except OSError:
+            self.close()
+            raise
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+def benchmark(paths, keyframe_interval, chunk):
+    encoder = Encoder(keyframe_interval=keyframe_interval)
+    decoder = None
+    total_bytes = total_frame = encode_s = decode_s = 0
+    keys = 0
+    for path in paths:
+        with open(path, 'rb') as framefile:
+            frame = framefile.read()
+        decoder = decoder or Decoder(len(frame))
+        started = time.perf_counter()
+        message = encoder.encode(frame)
+        encoded = time.perf_counter()
+        updates = []
+        for start in range(0, len(message), chunk):
+            updates += decoder.feed(message[start:start + chunk])
+        decode_s += time.perf_counter() - encoded
+        encode_s += encoded - started
+        if len(updates) != 1 or updates[0].frame != frame:
+            raise FrameCodecError('{} did not round-trip'.format(path))
+        keys += updates[0].rows is None
+        total_bytes += len(message)
+        total_frame += len(frame)
+    count = len(paths)
+    print('{} frames ({} keyframes): {:.0f} bytes per update on average, {:.1f}% of the raw frames'
+          .format(count, keys, total_bytes / count, 100.0 * total_bytes / total_frame))
+    print('encode {:.2f} ms, decode {:.2f} ms per frame (fed in {} byte pieces)'
+          .format(encode_s * 1000 / count, decode_s * 1000 / count, chunk))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measure the delta frame format on a recorded frame sequence.')
+    parser.add_argument('frames', help='directory of packed frames (render_batch.py --format epd)')
+    parser.add_argument('--keyframe-interval', type=int, default=DEFAULT_KEYFRAME_INTERVAL)
+    parser.add_argument('--chunk', type=int, default=1024, help='bytes per feed() call, like socket reads')
+    args = parser.parse_args(argv)
+    paths = sorted(glob.glob(os.path.join(args.frames, '*.bin')))
+    if not paths:
+        raise SystemExit('No .bin frames in ' + args.frames)
+    benchmark(paths, args.keyframe_interval, args.chunk)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+'''
+Shared-memory frame handoff between the renderer and the panel driver.
+
+The renderer publishes each packed 800x480 frame into a memory-mapped file
+together with a generation counter, the refresh mode it chose and a list of
+dirty rectangles. panel_driver.py maps the same file and pushes every new
+generation to the panel.
+
+Layout (little endian):
+
+    header   magic 'TIDE', version u32, generation u64, mode u32,
+             rect count u32, frame length u32
+    rects    MAX_RECTS x (x0, y0, x1, y1) u16
+    frame    packed frame bytes
+
+The generation works as a sequence lock: it is odd while the writer is
+updating the segment, and a reader retries until it sees the same even
+generation before and after copying.
+
+Only the standard library is used so the driver process stays small.
+'''
+import mmap
+import os
+import struct
+import time
+
+MAGIC = b'TIDE'
+VERSION = 1
+HEADER = struct.Struct('<4sIQIII')
+RECT = struct.Struct('<HHHH')
+MAX_RECTS = 16
+FRAME_OFFSET = HEADER.size + RECT.size * MAX_RECTS
+GENERATION_OFFSET = 8
+
+MODES = ('full', 'fast', 'partial')
+
+SHM_DIR = '/dev/shm'
+
+
+def default_path(state_path, display=None):
+    """Where a display publishes without "frame_shm": in RAM under /dev/shm
+    when there is one, otherwise in its state directory. One file per display
+    profile, so renderers for different panels don't overwrite each other."""
+    if os.path.isdir(SHM_DIR):
+        return os.path.join(SHM_DIR, 'tide_tracker_frame' + ('_' + display if display else ''))
+    return os.path.join(state_path, 'frame.shm')
+
+
+def _open(path, frame_bytes):
+    size = FRAME_OFFSET + frame_bytes
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        if os.fstat(fd).st_size != size:
+            os.ftruncate(fd, size)
+        return mmap.mmap(fd, size)
+    finally:
+        os.close(fd)
+
+
+class FrameWriter:
+    def __init__(self, path, frame_bytes):
+        self.frame_bytes = frame_bytes
+        self.map = _open(path, frame_bytes)
+        magic, version, generation, _, _, length = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION or length != frame_bytes:
+            HEADER.pack_into(self.map, 0, MAGIC, VERSION, 0, 0, 0, frame_bytes)
+            generation = 0
+        self.generation = generation + (generation & 1)  # recover from a writer that died mid-update
+
+    def publish(self, frame, mode, rects=()):
+        """Publish a frame; rects are (x0, y0, x1, y1) dirty areas for partial mode."""
+        if len(frame) != self.frame_bytes:
+            raise ValueError('frame is {} bytes, expected {}'.format(len(frame), self.frame_bytes))
+        rects = list(rects)[:MAX_RECTS]
+        struct.pack_into('<Q', self.map, GENERATION_OFFSET, self.generation + 1)
+        for index, rect in enumerate(rects):
+            RECT.pack_into(self.map, HEADER.size + index * RECT.size, *rect)
+        self.map[FRAME_OFFSET:FRAME_OFFSET + self.frame_bytes] = bytes(frame)
+        self.generation += 2
+        HEADER.pack_into(self.map, 0, MAGIC, VERSION, self.generation, MODES.index(mode),
+                         len(rects), self.frame_bytes)
+        return self.generation
+
+    def close(self):
+        self.map.close()
+
+
+class FrameReader:
+    def __init__(self, path, frame_bytes):
+        self.path = path
+        self.map = _open(path, frame_bytes)
+
+    def read(self):
+        """Return (generation, mode, rects, frame) for a consistent snapshot."""
+        while True:
+            magic, version, generation, mode, count, length = HEADER.unpack_from(self.map, 0)
+            if generation & 1:
+                time.sleep(0.001)
+                continue
+            rects = [RECT.unpack_from(self.map, HEADER.size + i * RECT.size)
+                     for i in range(min(count, MAX_RECTS))]
+            frame = self.map[FRAME_OFFSET:FRAME_OFFSET + length]
+            if struct.unpack_from('<Q', self.map, GENERATION_OFFSET)[0] == generation:
+                return generation, MODES[mode], rects, frame
+
+    def wait(self, last_generation, poll_interval=0.2, stop=None):
+        """Block until a generation newer than last_generation is published.
+        Returns None if stop (a threading.Event) is set first."""
+        while True:
+            generation = struct.unpack_from('<Q', self.map, GENERATION_OFFSET)[0]
+            if generation > last_generation and not generation & 1:
+                return self.read()
+            if stop is None:
+                time.sleep(poll_interval)
+            elif stop.wait(poll_interval):
+                return None
+
+    def close(self):
+        self.map.close()
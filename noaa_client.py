@@ -0,0 +1,85 @@
+'''
+Minimal client for the NOAA CO-OPS data API.
+
+Builds datagetter URLs and parses the JSON responses straight into NumPy
+arrays, so the tracker doesn't need noaa_coops (and with it pandas, zeep and
+lxml) just to fetch a day of water levels.
+'''
+from collections import namedtuple
+from urllib.parse import urlencode
+
+import numpy as np
+
+DATA_API_URL = 'https://api.tidesandcurrents.noaa.gov/api/prod/datagetter'
+
+# Water level or prediction series: times are local station time (lst_ldt)
+TideSeries = namedtuple('TideSeries', ['times', 'values'])
+
+# High/low tide predictions
+HILO_DTYPE = np.dtype([('t', 'datetime64[m]'), ('v', np.float64), ('type', 'U1')])
+
+
+class NOAAError(Exception):
+    pass
+
+
+def build_url(station, begin_date, end_date, product, datum='MLLW', interval=None,
+              time_zone='lst_ldt', units='metric', application=None):
+    params = {
+        'station': station,
+        'begin_date': begin_date,
+        'end_date': end_date,
+        'product': product,
+        'datum': datum,
+        'time_zone': time_zone,
+        'units': units,
+        'format': 'json',
+    }
+    if interval:
+        params['interval'] = interval
+    if application:
+        params['application'] = application
+    return DATA_API_URL + '?' + urlencode(params)
+
+
+def _rows(payload, key):
+    if 'error' in payload:
+        raise NOAAError(payload['error'].get('message', 'unknown NOAA error'))
+    try:
+        return payload[key]
+    except KeyError:
+        raise NOAAError('NOAA response has no {!r} field'.format(key))
+
+
+def parse_series(payload, key='data'):
+    """Parse a water_level or predictions response into a TideSeries.
+    Missing readings (empty strings) become NaN."""
+    rows = _rows(payload, key)
+    times = np.array([row['t'] for row in rows], dtype='datetime64[m]')
+    values = np.array([row['v'] or 'nan' for row in rows], dtype=np.float64)
+    return TideSeries(times, values)
+
+
+def parse_hilo(payload):
+    """Parse an interval=hilo predictions response into a HILO_DTYPE array."""
+    rows = _rows(payload, 'predictions')
+    hilo = np.empty(len(rows), dtype=HILO_DTYPE)
+    hilo['t'] = [row['t'] for row in rows]
+    hilo['v'] = [row['v'] or 'nan' for row in rows]
+    hilo['type'] = [row['type'] for row in rows]
+    return hilo
+
+
+def series_from_dataframe(frame):
+    """Convert a noaa_coops DataFrame to a TideSeries."""
+    return TideSeries(frame.index.values.astype('datetime64[m]'),
+                      frame['v'].to_numpy(dtype=np.float64))
+
+
+def hilo_from_dataframe(frame):
+    """Convert a noaa_coops hilo DataFrame to a HILO_DTYPE array."""
+    hilo = np.empty(len(frame), dtype=HILO_DTYPE)
+    hilo['t'] = frame.index.values.astype('datetime64[m]')
+    hilo['v'] = frame['v'].to_numpy(dtype=np.float64)
+    hilo['type'] = frame['type'].to_numpy(dtype=str)
+    return hilo
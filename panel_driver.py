@@ -0,0 +1,212 @@
+'''
+Resident panel driver process.
+
+Waits for frames published by the renderer through frame_shm and pushes
+them to the panel. It only needs the waveshare driver (spidev, gpiozero) in
+memory, and because it outlives the renderer the panel is always put back
+to sleep, even if a render crashes.
+
+Run it as a service and set "panel_output": "shm" in config.json:
+
+    python panel_driver.py
+
+With "panels" in config.json it drives several panels on one SPI bus (see
+spi_bus.py), one thread per panel, each reading its own frame_shm file.
+
+On a remote pier it receives delta-encoded frames over the network instead
+(see frame_codec.py); the renderer sets "panel_output": "remote":
+
+    python panel_driver.py --listen 9750
+'''
+import argparse
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+
+import frame_codec
+import frame_shm
+import spi_bus
+import tide_config
+
+script_dir = os.path.dirname(os.path.realpath(__file__))
+
+logger = logging.getLogger(__name__)
+
+
+def push_frame(epd, mode, frame, rows=None):
+    """Send a packed frame with the given refresh mode and leave the panel asleep.
+    rows is the (start, end) band to update in partial mode."""
+    row_bytes = epd.width // 8
+    if mode == 'full':
+        epd.init()
+        epd.display(frame)
+    elif mode == 'fast':
+        epd.init_fast()
+        epd.display(frame)
+    else:
+        # Partial window covers the changed rows at full width
+        start, end = rows
+        epd.init_part()
+        epd.display_Partial(frame[start * row_bytes:end * row_bytes], 0, start, epd.width, end)
+    epd.sleep() # Put screen to sleep to prevent damage
+
+
+def rows_from_rects(rects):
+    if not rects:
+        return None
+    return min(rect[1] for rect in rects), max(rect[3] for rect in rects)
+
+
+def push_logged(epd, name, generation, mode, frame, rows=None):
+    """push_frame that logs failures instead of raising, and always tries
+    to leave the panel asleep."""
+    logger.info('%s: pushing generation %d (%s)', name, generation, mode)
+    try:
+        push_frame(epd, mode, frame, rows)
+    except Exception:
+        logger.exception('%s: pushing generation %d failed', name, generation)
+        try:
+            epd.sleep()
+        except Exception:
+            logger.exception('%s: could not put panel to sleep', name)
+    metrics = getattr(epd.config, 'metrics', None)
+    if metrics is not None:
+        logger.info('%s: %s', name, metrics)
+
+
+def serve(epd, reader, stop, name='panel'):
+    """Push every frame published through reader to epd until stop is set."""
+    def push(generation, mode, frame, rows=None):
+        push_logged(epd, name, generation, mode, frame, rows)
+
+    # A frame published before we started is pushed with a full refresh
+    generation, mode, rects, frame = reader.read()
+    if generation:
+        push(generation, 'full', frame)
+
+    logger.info('%s: waiting for frames in %s', name, reader.path)
+    while True:
+        published = reader.wait(generation, stop=stop)
+        if published is None:
+            break
+        last_generation = generation
+        generation, mode, rects, frame = published
+        rows = rows_from_rects(rects)
+        # rects are relative to the previous publish; if we skipped it, the
+        # panel is missing that frame's changes too
+        if mode == 'partial' and (rows is None or generation != last_generation + 2):
+            mode = 'fast'
+        push(generation, mode, frame, rows)
+    reader.close()
+
+
+def serve_remote(epd, address, stop, name='panel'):
+    """Receive delta-encoded frames (frame_codec) on a TCP address ("[host:]port")
+    and push them to epd until stop is set. One renderer connects at a time."""
+    host, _, port = address.rpartition(':')
+    server = socket.create_server((host, int(port)))
+    server.settimeout(1)
+    frame_bytes = epd.width // 8 * epd.height
+    pushed = False
+    logger.info('%s: listening on %s', name, address)
+    while not stop.is_set():
+        try:
+            conn, peer = server.accept()
+        except socket.timeout:
+            continue
+        logger.info('%s: renderer connected from %s', name, peer[0])
+        # The sender starts every connection with a keyframe
+        decoder = frame_codec.Decoder(frame_bytes, epd.width // 8)
+        with conn:
+            conn.settimeout(1)
+            while not stop.is_set():
+                try:
+                    data = conn.recv(65536)
+                except socket.timeout:
+                    continue
+                except OSError:
+                    break
+                if not data:
+                    break
+                try:
+                    updates = decoder.feed(data)
+                except frame_codec.FrameCodecError as error:
+                    # Drop the connection; the renderer reconnects with a keyframe
+                    logger.error('%s: %s', name, error)
+                    break
+                if not updates:
+                    continue
+                # Every update is already in the frame, so one refresh covers them
+                # all: the strongest mode asked for, over all their changed rows
+                spans = [update.rows for update in updates if update.rows != (0, 0)]
+                mode = min((update.mode for update in updates), key=frame_shm.MODES.index)
+                rows = None
+                if not pushed:
+                    mode = 'full'
+                elif not spans:
+                    continue
+                elif None in spans:
+                    mode = 'fast' if mode == 'partial' else mode
+                else:
+                    rows = min(span[0] for span in spans), max(span[1] for span in spans)
+                push_logged(epd, name, updates[-1].sequence, mode, updates[-1].frame, rows)
+                pushed = True
+        logger.info('%s: renderer disconnected', name)
+    server.close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Push frames from the renderer to the panel.')
+    parser.add_argument('--listen', metavar='[HOST:]PORT',
+                        help='receive frames over TCP from a renderer with "panel_output": "remote"')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    sys.path.append(os.path.join(script_dir, 'lib'))
+    from waveshare_epd import epd7in5_V2
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+
+    if args.listen:
+        # A remote panel needs no config.json
+        serve_remote(epd7in5_V2.EPD(), args.listen, stop)
+        logger.info('Panel driver stopped.')
+        return
+
+    config = tide_config.get()
+    if not config.panels:
+        path = config.frame_shm or frame_shm.default_path(config.state_path, config.display)
+        epd = epd7in5_V2.EPD()
+        serve(epd, frame_shm.FrameReader(path, epd.width // 8 * epd.height), stop)
+        logger.info('Panel driver stopped.')
+        return
+
+    # Several panels on one SPI bus, each fed by its own renderer
+    bus = spi_bus.SpiBus()
+    threads = []
+    for settings in config.panels:
+        pins = {k: v for k, v in settings.items() if k != 'frame_shm'}
+        epd = epd7in5_V2.EPD(bus.panel(**pins))
+        reader = frame_shm.FrameReader(settings['frame_shm'], epd.width // 8 * epd.height)
+        thread = threading.Thread(target=serve, args=(epd, reader, stop, settings['name']),
+                                  name=settings['name'], daemon=True)
+        thread.start()
+        threads.append(thread)
+    # Join with a timeout so the signal handlers still run
+    while any(thread.is_alive() for thread in threads):
+        for thread in threads:
+            thread.join(timeout=1)
+    bus.close()
+    logger.info('Panel driver stopped.')
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s: %(message)s')
+    main()
@@ -0,0 +1,109 @@
+'''
+On-demand profiling of one refresh cycle.
+
+profile_cycle() wraps a cycle in cProfile, tracemalloc and a small stack
+sampler, and writes to the profile directory:
+
+    <stamp>.pstats          cProfile stats (python -m pstats, snakeviz, ...)
+    <stamp>.txt             top functions by cumulative time
+    <stamp>.collapsed.txt   sampled stacks of every thread in collapsed
+                            format, for flamegraph.pl / speedscope
+    <stamp>.alloc.txt       top allocation sites from tracemalloc
+
+Turn it on for every cycle with TIDE_PROFILE=1 or "profile": true in
+config.json. A long-running process profiles its next cycle after SIGUSR1.
+cProfile only sees the thread that runs the cycle; the panel worker and
+fetch threads show up in the sampled stacks. profile_cycle() yields the base
+path of the files it will write.
+'''
+import collections
+import cProfile
+import io
+import os
+import pstats
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+_requested = threading.Event()
+
+
+def install_signal_handler(signum=signal.SIGUSR1):
+    """Profile the next cycle when signum arrives."""
+    signal.signal(signum, lambda signum, frame: _requested.set())
+
+
+def requested(always=False):
+    """True if this cycle should be profiled; consumes a pending signal."""
+    if always or os.environ.get('TIDE_PROFILE') == '1':
+        return True
+    if _requested.is_set():
+        _requested.clear()
+        return True
+    return False
+
+
+class StackSampler(threading.Thread):
+    def __init__(self, interval):
+        super().__init__(name='stack-sampler', daemon=True)
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        own_id = threading.get_ident()
+        while not self._stop_event.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename),
+                                                     code.co_firstlineno))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+@contextmanager
+def profile_cycle(out_dir, top_n=25, sample_interval=0.005):
+    os.makedirs(out_dir, exist_ok=True)
+    stamp = time.strftime('%Y%m%d_%H%M%S')
+    base = os.path.join(out_dir, stamp)
+
+    tracemalloc.start()
+    sampler = StackSampler(sample_interval)
+    sampler.start()
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield base
+    finally:
+        profiler.disable()
+        sampler.stop()
+        allocations = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+
+        profiler.dump_stats(base + '.pstats')
+        summary = io.StringIO()
+        pstats.Stats(profiler, stream=summary).sort_stats('cumulative').print_stats(top_n)
+        with open(base + '.txt', 'w') as summaryfile:
+            summaryfile.write(summary.getvalue())
+
+        with open(base + '.collapsed.txt', 'w') as stackfile:
+            for stack, count in sampler.stacks.most_common():
+                stackfile.write('{} {}\n'.format(stack, count))
+
+        with open(base + '.alloc.txt', 'w') as allocfile:
+            for stat in allocations.statistics('lineno')[:top_n]:
+                allocfile.write(str(stat) + '\n')
+        print('Profile written to', base + '.*')
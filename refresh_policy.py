@@ -0,0 +1,128 @@
+'''
+Refresh-mode scheduling for the e-paper panel.
+
+The driver offers three ways to update the panel:
+
+    full     init() + display()          slowest, flashes, clears ghosting
+    fast     init_fast() + display()     quicker full-frame waveform
+    partial  init_part() + display_Partial()  no flash, but ghosts build up
+
+RefreshPolicy picks one per frame from how much of the frame changed, how
+long ago the last full refresh was, how many partial refreshes have happened
+since, and optional quiet hours. State is kept on disk because the tracker
+normally runs as a fresh process from cron.
+'''
+import datetime as dt
+import json
+import logging
+import os
+from collections import namedtuple
+
+import clock
+import epd_frame
+
+logger = logging.getLogger(__name__)
+
+RefreshDecision = namedtuple('RefreshDecision', ['mode', 'reason', 'rows'])
+
+FULL = 'full'
+FAST = 'fast'
+PARTIAL = 'partial'
+SKIP = 'skip'
+
+DEFAULTS = {
+    'partial_max_changed': 0.10,       # fraction of pixels; above this use a fast refresh
+    'max_partials': 10,                # partial refreshes allowed before a fast refresh
+    'full_refresh_interval': 6 * 3600, # seconds between full (ghost clearing) refreshes
+    'quiet_hours': None,               # e.g. ["22:00", "06:00"]; only partial updates
+}
+
+
+def parse_hhmm(value):
+    hour, minute = value.split(':')
+    return dt.time(int(hour), int(minute))
+
+
+def in_quiet_hours(quiet_hours, now):
+    if not quiet_hours:
+        return False
+    start, end = (parse_hhmm(t) for t in quiet_hours)
+    current = now.time()
+    if start <= end:
+        return start <= current < end
+    return current >= start or current < end  # window wraps midnight
+
+
+class RefreshPolicy:
+    def __init__(self, state_dir, **settings):
+        self.settings = dict(DEFAULTS)
+        self.settings.update({k: v for k, v in settings.items() if v is not None})
+        self.state_path = os.path.join(state_dir, 'refresh_state.json')
+        self.frame_path = os.path.join(state_dir, 'last_frame.bin')
+        self.last_full = 0.0
+        self.partials_since_full = 0
+        self.last_frame = None
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.state_path, 'r') as statefile:
+                state = json.load(statefile)
+            with open(self.frame_path, 'rb') as framefile:
+                frame = framefile.read()
+        except (OSError, ValueError):
+            return
+        if len(frame) != epd_frame.FRAME_BYTES:
+            return
+        self.last_full = state.get('last_full', 0.0)
+        self.partials_since_full = state.get('partials_since_full', 0)
+        self.last_frame = frame
+
+    def decide(self, frame, now=None):
+        """Pick a refresh mode for the packed frame and log the decision."""
+        decision = self._decide(frame, clock.time() if now is None else now)
+        logger.info('Refresh decision: %s (%s)', decision.mode, decision.reason)
+        return decision
+
+    def _decide(self, frame, now):
+        if self.last_frame is None:
+            return RefreshDecision(FULL, 'no previous frame', None)
+
+        rows = epd_frame.changed_row_span(self.last_frame, frame)
+        if rows is None:
+            return RefreshDecision(SKIP, 'frame unchanged', None)
+
+        changed = epd_frame.changed_pixels(self.last_frame, frame) / (len(frame) * 8)
+        detail = '{:.1%} changed, {} partials, last full {:.0f}s ago'.format(
+            changed, self.partials_since_full, now - self.last_full)
+
+        if in_quiet_hours(self.settings['quiet_hours'], dt.datetime.fromtimestamp(now)):
+            return RefreshDecision(PARTIAL, 'quiet hours; ' + detail, rows)
+        if now - self.last_full >= self.settings['full_refresh_interval']:
+            return RefreshDecision(FULL, 'full refresh interval elapsed; ' + detail, None)
+        if self.partials_since_full >= self.settings['max_partials']:
+            return RefreshDecision(FAST, 'partial limit reached; ' + detail, None)
+        if changed <= self.settings['partial_max_changed']:
+            return RefreshDecision(PARTIAL, 'small change; ' + detail, rows)
+        return RefreshDecision(FAST, 'large change; ' + detail, None)
+
+    def record(self, decision, frame, now=None):
+        """Persist state after the panel has been updated."""
+        if decision.mode == SKIP:
+            return
+        now = clock.time() if now is None else now
+        if decision.mode == FULL:
+            self.last_full = now
+            self.partials_since_full = 0
+        elif decision.mode == FAST:
+            self.partials_since_full = 0
+        else:
+            self.partials_since_full += 1
+        self.last_frame = bytes(frame)
+
+        os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+        with open(self.frame_path, 'wb') as framefile:
+            framefile.write(self.last_frame)
+        with open(self.state_path, 'w') as statefile:
+            json.dump({'last_full': self.last_full,
+                       'partials_since_full': self.partials_since_full}, statefile)
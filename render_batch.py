@@ -0,0 +1,101 @@
+'''
+Batch frame rendering from recorded data.
+
+Renders the tide_tracker frame at every step of a time range, using the
+replayed fixtures (see fixtures.py) on a virtual clock, and writes PNGs or
+packed EPD buffers plus a per-frame timing report. The panel is never
+touched. Useful for regression-testing layout changes and for measuring
+sustained render throughput outside of cron.
+
+    python render_batch.py --start 2026-10-01T00:00 --end 2026-10-08T00:00 \\
+        --step 10 --out frames --format png
+'''
+import argparse
+import csv
+import datetime as dt
+import os
+import resource
+import sys
+import tempfile
+import time
+
+os.environ.setdefault('TIDE_FIXTURES', 'replay')
+# Keep the virtual-time caches away from the live ones (the modules below
+# open theirs on import), and drop them afterwards
+_cache = tempfile.TemporaryDirectory(prefix='tide_batch_', ignore_cleanup_errors=True)
+os.environ['TIDE_CACHE_DIR'] = _cache.name
+
+import clock
+import epd_frame
+import tide_display
+
+
+class BatchEPD:
+    width = epd_frame.EPD_WIDTH
+    height = epd_frame.EPD_HEIGHT
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Render tide_tracker frames over a time range.')
+    parser.add_argument('--start', required=True, type=dt.datetime.fromisoformat)
+    parser.add_argument('--end', required=True, type=dt.datetime.fromisoformat)
+    parser.add_argument('--step', type=int, default=10, help='minutes between frames')
+    parser.add_argument('--out', default='frames', help='output directory')
+    parser.add_argument('--format', choices=('png', 'epd'), default='png',
+                        help='PNG images or packed 48,000 byte EPD buffers')
+    return parser.parse_args(argv)
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    os.makedirs(args.out, exist_ok=True)
+
+    with _cache:
+        epd = BatchEPD()
+        step = dt.timedelta(minutes=args.step)
+        report_path = os.path.join(args.out, 'timing.csv')
+        frames = 0
+        started = time.perf_counter()
+        with open(report_path, 'w', newline='') as reportfile:
+            report = csv.writer(reportfile)
+            report.writerow(['time', 'file', 'fetch_s', 'compose_s', 'write_s', 'total_s'])
+            when = args.start
+            while when <= args.end:
+                clock.set_time(when)
+                t0 = time.perf_counter()
+                data = tide_display.fetch_data()
+                t1 = time.perf_counter()
+                image = tide_display.compose_frame(epd, data)
+                t2 = time.perf_counter()
+
+                name = when.strftime('frame_%Y%m%d_%H%M')
+                if args.format == 'png':
+                    name += '.png'
+                    image.save(os.path.join(args.out, name))
+                else:
+                    name += '.bin'
+                    with open(os.path.join(args.out, name), 'wb') as framefile:
+                        framefile.write(epd_frame.pack(image))
+                image.close()
+                t3 = time.perf_counter()
+
+                report.writerow([when.isoformat(), name, '{:.4f}'.format(t1 - t0),
+                                 '{:.4f}'.format(t2 - t1), '{:.4f}'.format(t3 - t2),
+                                 '{:.4f}'.format(t3 - t0)])
+                frames += 1
+                when += step
+
+    elapsed = time.perf_counter() - started
+    clock.set_time(None)
+    print('Rendered {} frames in {:.1f}s ({:.2f} frames/s), peak RSS {:.1f} MB'.format(
+        frames, elapsed, frames / elapsed if elapsed else 0.0, peak_rss_mb()))
+    print('Timing report:', report_path)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,128 @@
+'''
+Last-known-good snapshots for data sources (stale-while-revalidate).
+
+SnapshotStore.get_all runs each source's fetch on a worker thread and waits
+at most `timeout` seconds for them. If the fetch fails or is still running, the
+last good value is returned together with its age, so rendering never waits
+on (or dies with) a failing upstream. A fetch that finishes late still
+updates the snapshot for the next cycle. The fetch threads are daemons, so a
+one-shot (cron) run calls drain() before it exits to keep those late results.
+
+Ages are those of the data, not of the fetch: a value built from cached API
+responses is as old as the oldest of them, and one api_budget served from
+its stale fallback is not fresh.
+'''
+import logging
+import os
+import pickle
+import threading
+import time
+from collections import namedtuple
+
+import api_budget
+import clock
+
+logger = logging.getLogger(__name__)
+
+# value is None when the source has never been fetched successfully
+Snapshot = namedtuple('Snapshot', ['value', 'age', 'fresh'])
+
+
+class SnapshotStore:
+    def __init__(self, cache_dir):
+        self.snapshot_dir = os.path.join(cache_dir, 'snapshots')
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._inflight = {}
+
+    def _path(self, name):
+        return os.path.join(self.snapshot_dir, name + '.pickle')
+
+    def load(self, name):
+        """Return (value, saved_at) of the last good snapshot, or (None, None)."""
+        try:
+            with open(self._path(name), 'rb') as snapshotfile:
+                return pickle.load(snapshotfile)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None, None
+
+    def save(self, name, value, saved_at=None):
+        """Store value; saved_at is when its data was fetched, default now."""
+        path = self._path(name)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as snapshotfile:
+            pickle.dump((value, clock.time() if saved_at is None else saved_at), snapshotfile)
+        os.replace(tmp_path, path)
+
+    def written_at(self, name):
+        """Wall-clock time the snapshot file was last written, or None. Cheaper
+        than load(), which unpickles the value (and imports NumPy)."""
+        try:
+            return os.path.getmtime(self._path(name))
+        except OSError:
+            return None
+
+    def invalidate(self, *names):
+        """Forget the snapshots for names, e.g. after their source was reconfigured."""
+        for name in names:
+            try:
+                os.remove(self._path(name))
+            except FileNotFoundError:
+                pass
+
+    def _refresh(self, name, fetch_fn, result):
+        try:
+            with api_budget.served() as responses:
+                value = fetch_fn()
+            fetched_at = min((at for at, _ in responses), default=clock.time())
+            self.save(name, value, fetched_at)
+            result.update(value=value, fetched_at=fetched_at,
+                          fresh=not any(fell_back for _, fell_back in responses))
+        except Exception as error:
+            logger.warning('Refreshing %s failed: %s', name, api_budget.redact(error))
+        finally:
+            with self._lock:
+                self._inflight.pop(name, None)
+
+    def _start(self, name, fetch_fn):
+        with self._lock:
+            worker = self._inflight.get(name)
+            if worker is None:
+                result = {}
+                worker = threading.Thread(target=self._refresh, args=(name, fetch_fn, result),
+                                          name='refresh-' + name, daemon=True)
+                worker.result = result
+                self._inflight[name] = worker
+                worker.start()
+        return worker
+
+    def _collect(self, name, worker):
+        result = worker.result
+        if 'value' in result:
+            age = max(clock.time() - result['fetched_at'], 0.0)
+            if not result['fresh']:
+                logger.info('Using %s from a cached response %.0fs old', name, age)
+            return Snapshot(result['value'], age, result['fresh'])
+        value, saved_at = self.load(name)
+        if value is None:
+            return Snapshot(None, None, False)
+        age = clock.time() - saved_at
+        logger.info('Using %s snapshot from %.0fs ago', name, age)
+        return Snapshot(value, age, False)
+
+    def get_all(self, fetchers, timeout):
+        """Refresh every source in fetchers ({name: fetch_fn}) concurrently and
+        return {name: Snapshot}, waiting at most timeout seconds in total."""
+        workers = {name: self._start(name, fetch_fn) for name, fetch_fn in fetchers.items()}
+        deadline = time.monotonic() + timeout
+        for worker in workers.values():
+            worker.join(max(deadline - time.monotonic(), 0))
+        return {name: self._collect(name, worker) for name, worker in workers.items()}
+
+    def drain(self, timeout):
+        """Wait up to timeout seconds for fetches that are still running."""
+        with self._lock:
+            workers = list(self._inflight.values())
+        deadline = time.monotonic() + timeout
+        for worker in workers:
+            worker.join(max(deadline - time.monotonic(), 0))
@@ -0,0 +1,44 @@
+'''
+The data sources a display draws, with their response cache keys and
+polling intervals.
+
+weather_tides_api fetches through these keys. Only the standard library is
+used, so tide_tracker.py can tell whether the cache already holds everything
+a refresh would fetch without importing requests (see cached_responses()).
+'''
+import cadence
+
+# Minimum seconds between upstream calls for the same data
+WEATHER_MIN_INTERVAL = 600      # OpenWeather updates current conditions about every 10 minutes
+HILO_MIN_INTERVAL = 6 * 3600    # predictions don't change during the day
+
+
+def water_level_interval(now):
+    """NOAA publishes water level every 6 minutes, so a cached copy is good
+    until the next publish slot: the seconds since the last one. A fixed 6
+    minutes would skip every other slot for polls lined up with them."""
+    return now - cadence.last_publish_slot(now)
+
+
+def weather_key(latitude, longitude, units):
+    return 'weather:{}:{}:{}'.format(latitude, longitude, units)
+
+
+def water_level_key(station):
+    return 'water_level_24h:' + station
+
+
+def hilo_key(station, day):
+    return 'hilo:{}:{}'.format(station, day.strftime('%Y%m%d'))
+
+
+def cached_responses(config, now):
+    """[(snapshot name, cache key, min interval)] for the responses a display
+    with config draws at now; None when a source bypasses the response cache."""
+    if config.noaa_backend == 'noaa_coops':
+        return None
+    return [
+        ('weather', weather_key(config.latitude, config.longitude, config.units), WEATHER_MIN_INTERVAL),
+        ('water_level', water_level_key(config.noaa_station_id), water_level_interval(now.timestamp())),
+        ('hilo', hilo_key(config.noaa_station_id, now), HILO_MIN_INTERVAL),
+    ]
@@ -0,0 +1,345 @@
+'''
+One SPI bus shared by several panels.
+
+epdconfig opens SPI bus 0 device 0 and one fixed set of RST/DC/BUSY pins, so
+a second panel on the same Pi means a second process fighting over the bus.
+SpiBus owns the SPI devices and GPIO pins instead and hands out one
+PanelInterface per panel. A PanelInterface looks like the epdconfig module,
+so the unchanged driver works on it: epd7in5_V2.EPD(bus.panel(...)).
+
+  * Each panel has its own pin map and chip select: a hardware chip enable
+    ("spi": [bus, device]) or a GPIO pin driven around every transfer
+    ("cs").
+  * Transfers are cut into CHUNK_BYTES pieces and every piece takes the bus
+    through a FIFO lock, so panels get the bus in turn and one panel's 96 KB
+    frame push doesn't hold the others up.
+  * While a panel is BUSY (a full refresh takes seconds) its driver polls
+    every BUSY_POLL seconds without holding the bus, so the other panels
+    push their frames meanwhile. N panels refresh in about the time of one.
+  * A shared power pin stays on until the last panel has gone to sleep.
+  * Per-panel metrics: bytes, transfers, time waiting for and holding the
+    bus, and time spent waiting on BUSY.
+
+    python spi_bus.py --simulate 3    # timing with simulated panels
+'''
+import argparse
+import collections
+import threading
+import time
+
+SPI_SPEED_HZ = 4000000
+CHUNK_BYTES = 4096
+BUSY_POLL = 0.02
+
+
+class FairLock:
+    """Lock handed out in the order it was asked for."""
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._next_ticket = 0
+        self._serving = 0
+
+    def acquire(self):
+        with self._condition:
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            while ticket != self._serving:
+                self._condition.wait()
+
+    def release(self):
+        with self._condition:
+            self._serving += 1
+            self._condition.notify_all()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class PanelMetrics:
+    __slots__ = ('transfers', 'bytes', 'bus_wait', 'bus_hold', 'busy_wait')
+
+    def __init__(self):
+        self.transfers = 0
+        self.bytes = 0
+        self.bus_wait = 0.0
+        self.bus_hold = 0.0
+        self.busy_wait = 0.0
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        return ('{} transfers, {} bytes, bus wait {:.2f}s, bus held {:.2f}s, busy wait {:.2f}s'
+                .format(self.transfers, self.bytes, self.bus_wait, self.bus_hold, self.busy_wait))
+
+
+class RaspberryPiHardware:
+    """spidev and gpiozero devices, as epdconfig.RaspberryPi uses them."""
+
+    def output(self, pin):
+        import gpiozero
+        return gpiozero.LED(pin)
+
+    def input(self, pin):
+        import gpiozero
+        return gpiozero.Button(pin, pull_up=False)
+
+    def spi(self, bus, device, speed_hz, manual_cs):
+        import spidev
+        spi = spidev.SpiDev()
+        spi.open(bus, device)
+        spi.max_speed_hz = speed_hz
+        spi.mode = 0b00
+        if manual_cs:
+            spi.no_cs = True
+        return spi
+
+
+class PanelInterface:
+    """The epdconfig interface for one panel on a shared SpiBus."""
+
+    def __init__(self, bus, name, spi, cs, rst, dc, busy, pwr):
+        self.bus = bus
+        self.name = name
+        self.RST_PIN = rst
+        self.DC_PIN = dc
+        self.CS_PIN = cs
+        self.BUSY_PIN = busy
+        self.PWR_PIN = pwr
+        self.SPI = self  # the driver calls epdconfig.SPI.writebytes2
+        self.metrics = PanelMetrics()
+        self._spi = bus._spi_device(spi[0], spi[1], manual_cs=cs is not None)
+        self._cs = bus._output(cs) if cs is not None else None
+        if self._cs is not None:
+            self._cs.on()
+        self._rst = bus._output(rst)
+        self._dc = bus._output(dc)
+        self._busy = bus._input(busy)
+
+    def digital_write(self, pin, value):
+        # Chip select is driven per transfer and power is shared, see module_init
+        if pin == self.RST_PIN:
+            self._rst.on() if value else self._rst.off()
+        elif pin == self.DC_PIN:
+            self._dc.on() if value else self._dc.off()
+
+    def digital_read(self, pin):
+        if pin != self.BUSY_PIN:
+            return 0
+        value = self._busy.value
+        if value == 0:
+            # Still busy: the driver polls again straight away, so wait here,
+            # off the bus, to let the other panels use it
+            time.sleep(self.bus.busy_poll)
+            self.metrics.busy_wait += self.bus.busy_poll
+        return value
+
+    def delay_ms(self, delaytime):
+        time.sleep(delaytime / 1000.0)
+
+    def spi_writebyte(self, data):
+        self.writebytes2(data)
+
+    def spi_writebyte2(self, data):
+        self.writebytes2(data)
+
+    def writebytes2(self, data):
+        chunk = self.bus.chunk_bytes
+        for start in range(0, len(data), chunk):
+            piece = data[start:start + chunk]
+            asked = time.monotonic()
+            with self.bus.lock:
+                granted = time.monotonic()
+                if self._cs is not None:
+                    self._cs.off()
+                self._spi.writebytes2(piece)
+                if self._cs is not None:
+                    self._cs.on()
+                released = time.monotonic()
+            self.metrics.transfers += 1
+            self.metrics.bytes += len(piece)
+            self.metrics.bus_wait += granted - asked
+            self.metrics.bus_hold += released - granted
+
+    def module_init(self, cleanup=False):
+        self.bus._power(self.PWR_PIN, True)
+        return 0
+
+    def module_exit(self, cleanup=False):
+        self._rst.off()
+        self._dc.off()
+        self.bus._power(self.PWR_PIN, False)
+
+
+class SpiBus:
+    def __init__(self, speed_hz=SPI_SPEED_HZ, chunk_bytes=CHUNK_BYTES, busy_poll=BUSY_POLL, hardware=None):
+        self.speed_hz = speed_hz
+        self.chunk_bytes = chunk_bytes
+        self.busy_poll = busy_poll
+        self.hardware = hardware or RaspberryPiHardware()
+        self.lock = FairLock()
+        self.panels = {}
+        self._devices = {}
+        self._outputs = {}
+        self._inputs = {}
+        self._powered = collections.Counter()
+        self._state = threading.Lock()
+
+    def panel(self, name, spi=(0, 0), cs=None, rst=17, dc=25, busy=24, pwr=18):
+        """Add a panel (defaults are the Waveshare HAT pins) and return its interface."""
+        if name in self.panels:
+            raise ValueError('panel {!r} is already on the bus'.format(name))
+        panel = PanelInterface(self, name, tuple(spi), cs, rst, dc, busy, pwr)
+        self.panels[name] = panel
+        return panel
+
+    def metrics(self):
+        return {name: panel.metrics.as_dict() for name, panel in self.panels.items()}
+
+    def close(self):
+        for device in list(self._devices.values()) + list(self._outputs.values()) + list(self._inputs.values()):
+            device.close()
+        self._devices.clear()
+        self._outputs.clear()
+        self._inputs.clear()
+
+    # Devices are shared between panels that use the same pin or chip enable
+
+    def _spi_device(self, bus, device, manual_cs):
+        with self._state:
+            if (bus, device) not in self._devices:
+                self._devices[bus, device] = self.hardware.spi(bus, device, self.speed_hz, manual_cs)
+            return self._devices[bus, device]
+
+    def _output(self, pin):
+        with self._state:
+            if pin not in self._outputs:
+                self._outputs[pin] = self.hardware.output(pin)
+            return self._outputs[pin]
+
+    def _input(self, pin):
+        with self._state:
+            if pin not in self._inputs:
+                self._inputs[pin] = self.hardware.input(pin)
+            return self._inputs[pin]
+
+    def _power(self, pin, on):
+        if pin is None:
+            return
+        output = self._output(pin)
+        with self._state:
+            if on:
+                self._powered[pin] += 1
+                output.on()
+            elif self._powered[pin] > 0:
+                self._powered[pin] -= 1
+                if self._powered[pin] == 0:
+                    output.off()
+
+
+# Simulated panels for --simulate: SPI transfers take their wire time and
+# the refresh/power commands hold BUSY low for about as long as a real 7.5" panel
+
+SIMULATED_BUSY = {0x04: 0.1, 0x02: 0.1, 0x12: 3.5}  # power on, power off, refresh
+
+
+class _SimulatedPin:
+    def __init__(self):
+        self.value = 0
+        self.busy_until = 0.0
+
+    def on(self):
+        self.value = 1
+
+    def off(self):
+        self.value = 0
+
+    def close(self):
+        pass
+
+
+class _SimulatedBusy(_SimulatedPin):
+    @property
+    def value(self):
+        return 0 if time.monotonic() < self.busy_until else 1
+
+    @value.setter
+    def value(self, value):
+        pass
+
+
+class _SimulatedSpi:
+    def __init__(self, speed_hz):
+        self.speed_hz = speed_hz
+        self.dc = None
+        self.busy = None
+
+    def writebytes2(self, data):
+        time.sleep(len(data) * 8.0 / self.speed_hz)
+        if len(data) == 1 and self.dc.value == 0 and data[0] in SIMULATED_BUSY:
+            self.busy.busy_until = time.monotonic() + SIMULATED_BUSY[data[0]]
+
+    def close(self):
+        pass
+
+
+class SimulatedHardware:
+    def output(self, pin):
+        return _SimulatedPin()
+
+    def input(self, pin):
+        return _SimulatedBusy()
+
+    def spi(self, bus, device, speed_hz, manual_cs):
+        return _SimulatedSpi(speed_hz)
+
+
+def simulate(count):
+    import os
+    import sys
+    sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'lib'))
+    from waveshare_epd import epd7in5_V2
+    import panel_driver
+
+    bus = SpiBus(hardware=SimulatedHardware())
+    epds = []
+    for index in range(count):
+        # Every panel on its own chip enable and its own RST/DC/BUSY pins
+        panel = bus.panel('panel{}'.format(index), spi=(0, index), rst=100 + index, dc=200 + index, busy=300 + index)
+        panel._spi.dc = panel._dc
+        panel._spi.busy = panel._busy
+        epds.append(epd7in5_V2.EPD(panel))
+    frame = bytearray(epds[0].width // 8 * epds[0].height)
+
+    started = time.monotonic()
+    panel_driver.push_frame(epds[0], 'full', frame)
+    single = time.monotonic() - started
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=panel_driver.push_frame, args=(epd, 'full', frame)) for epd in epds]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    shared = time.monotonic() - started
+
+    print('one panel: {:.2f}s, {} panels sharing the bus: {:.2f}s (sequential would be {:.2f}s)'
+          .format(single, count, shared, single * count))
+    for name, panel in bus.panels.items():
+        print('  {}: {}'.format(name, panel.metrics))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time full refreshes of panels sharing one SPI bus.')
+    parser.add_argument('--simulate', type=int, default=3, metavar='N', help='number of simulated panels')
+    args = parser.parse_args(argv)
+    simulate(args.simulate)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,220 @@
+'''
+Per-station tide history archive.
+
+Each fetched water level series is appended to a small on-disk archive, so
+weekly and monthly views don't need a bulk download. There are two tiers of
+fixed-width records per station and product:
+
+  * <product>.raw     every 6-minute sample of the last raw_days days
+                      (int32 minutes since 1970, float32 value)
+  * <product>.hourly  min/max/mean/count of every complete hour, kept forever
+
+Both files are plain arrays of records, memory-mapped for reads. A range
+query binary-searches the time column and reads only the rows inside the
+range, from the coarsest tier that still has more points than pixels, so a
+30-day chart touches about 720 hourly rows instead of 7,200 samples.
+
+Times are station local time, like the series noaa_client returns.
+
+    python tide_archive.py --days 30 --out month.png
+'''
+import argparse
+import datetime as dt
+import fcntl
+import os
+from contextlib import contextmanager
+
+import numpy as np
+
+import decimate
+import noaa_client
+
+RAW_DTYPE = np.dtype([('t', '<i4'), ('v', '<f4')])  # t: minutes since 1970
+HOURLY_DTYPE = np.dtype([('t', '<i4'), ('min', '<f4'), ('max', '<f4'),
+                         ('mean', '<f4'), ('count', '<u2')])  # t: hours since 1970
+
+DEFAULT_RAW_DAYS = 7
+TRIM_SLACK = 24 * 60  # minutes of expired raw samples tolerated before rewriting the raw file
+
+
+@contextmanager
+def _locked(path):
+    with open(path, 'a') as lockfile:
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+
+def _map(path, dtype):
+    """Memory-map the complete records in path (read-only)."""
+    try:
+        count = os.path.getsize(path) // dtype.itemsize
+    except OSError:
+        count = 0
+    if count == 0:
+        return np.empty(0, dtype)
+    return np.memmap(path, dtype=dtype, mode='r', shape=(count,))
+
+
+def _append(path, records):
+    with open(path, 'ab') as datafile:
+        # Drop a partial record left by an interrupted write
+        size = datafile.tell()
+        datafile.truncate(size - size % records.dtype.itemsize)
+        datafile.write(records.tobytes())
+
+
+def _minutes(when):
+    return int(np.datetime64(when, 'm').astype(np.int64))
+
+
+class TideArchive:
+    def __init__(self, archive_dir, station, product='water_level', raw_days=DEFAULT_RAW_DAYS):
+        self.dir = os.path.join(archive_dir, str(station))
+        self.raw_path = os.path.join(self.dir, product + '.raw')
+        self.hourly_path = os.path.join(self.dir, product + '.hourly')
+        self.lock_path = os.path.join(self.dir, product + '.lock')
+        self.raw_days = raw_days
+        os.makedirs(self.dir, exist_ok=True)
+
+    def raw(self):
+        return _map(self.raw_path, RAW_DTYPE)
+
+    def hourly(self):
+        return _map(self.hourly_path, HOURLY_DTYPE)
+
+    # Updates
+
+    def update(self, series):
+        """Append the samples of a TideSeries newer than the archive, roll
+        complete hours up and expire old raw samples. Returns the number of
+        samples added."""
+        times = series.times.astype('datetime64[m]').astype(np.int64)
+        keep = np.isfinite(series.values)
+        with _locked(self.lock_path):
+            raw = self.raw()
+            if raw.size:
+                keep &= times > raw['t'][-1]
+            fresh = np.empty(int(keep.sum()), RAW_DTYPE)
+            fresh['t'] = times[keep]
+            fresh['v'] = series.values[keep]
+            fresh = fresh[np.unique(fresh['t'], return_index=True)[1]]  # sorted, no repeats
+            if fresh.size:
+                _append(self.raw_path, fresh)
+                raw = self.raw()
+            if raw.size:
+                self._roll_up(raw)
+                self._trim(raw)
+        return fresh.size
+
+    def _roll_up(self, raw):
+        hourly = self.hourly()
+        hours = raw['t'] // 60
+        # The hour of the newest sample may still get more samples
+        first = np.searchsorted(hours, hourly['t'][-1] + 1) if hourly.size else 0
+        last = np.searchsorted(hours, hours[-1])
+        if last <= first:
+            return
+        hours = hours[first:last]
+        values = raw['v'][first:last].astype(np.float64)
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(hours)) + 1))
+        counts = np.diff(np.append(starts, len(values)))
+        rollup = np.empty(len(starts), HOURLY_DTYPE)
+        rollup['t'] = hours[starts]
+        rollup['min'] = np.minimum.reduceat(values, starts)
+        rollup['max'] = np.maximum.reduceat(values, starts)
+        rollup['mean'] = np.add.reduceat(values, starts) / counts
+        rollup['count'] = counts
+        _append(self.hourly_path, rollup)
+
+    def _trim(self, raw):
+        # Rewriting is cheap (a week is ~13 KB) but only done about once a day
+        cutoff = int(raw['t'][-1]) - self.raw_days * 24 * 60
+        if raw['t'][0] >= cutoff - TRIM_SLACK:
+            return
+        kept = np.array(raw[np.searchsorted(raw['t'], cutoff):])
+        tmp_path = self.raw_path + '.tmp'
+        with open(tmp_path, 'wb') as datafile:
+            datafile.write(kept.tobytes())
+        os.replace(tmp_path, self.raw_path)
+
+    # Queries
+
+    def span(self):
+        """(first, last) archived times as datetime64[m], or None if empty."""
+        raw, hourly = self.raw(), self.hourly()
+        if not raw.size and not hourly.size:
+            return None
+        first = hourly['t'][0] * 60 if hourly.size else raw['t'][0]
+        last = raw['t'][-1] if raw.size else hourly['t'][-1] * 60 + 59
+        return np.datetime64(int(first), 'm'), np.datetime64(int(last), 'm')
+
+    def read(self, start, end, width=None):
+        """Return the archived series between start and end as a TideSeries,
+        reduced to about 2 * width points when width is given."""
+        start, end = _minutes(start), _minutes(end)
+        raw = self.raw()
+        lo, hi = np.searchsorted(raw['t'], [start, end + 1]) if raw.size else (0, 0)
+        in_raw = raw.size and raw['t'][0] <= start
+        if in_raw and (width is None or hi - lo <= 4 * width):
+            times, values = raw['t'][lo:hi], raw['v'][lo:hi]
+        else:
+            times, values = self._read_hourly(start, end, width)
+            # Samples of the hour that hasn't been rolled up yet
+            tail = np.searchsorted(raw['t'], (times[-1] // 60 + 1) * 60) if len(times) else lo
+            tail = max(tail, lo)
+            times = np.concatenate((times, raw['t'][tail:hi]))
+            values = np.concatenate((values, raw['v'][tail:hi]))
+        series = noaa_client.TideSeries(np.asarray(times, dtype=np.int64).astype('datetime64[m]'),
+                                        np.asarray(values, dtype=np.float64))
+        if width:
+            series = noaa_client.TideSeries(*decimate.minmax(series.times, series.values, width))
+        return series
+
+    def _read_hourly(self, start, end, width):
+        hourly = self.hourly()
+        lo, hi = np.searchsorted(hourly['t'], [start // 60, end // 60 + 1]) if hourly.size else (0, 0)
+        rows = hourly[lo:hi]
+        if width is None or len(rows) <= width:
+            # One point per hour is finer than the chart; draw the mean mid-hour
+            return rows['t'].astype(np.int64) * 60 + 30, rows['mean']
+        # More hours than pixels: keep each hour's extremes for the min/max decimation
+        times = np.repeat(rows['t'].astype(np.int64) * 60, 2)
+        times[1::2] += 30
+        values = np.empty(len(times), np.float32)
+        values[0::2] = rows['min']
+        values[1::2] = rows['max']
+        return times, values
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Draw a chart of the archived water level.')
+    parser.add_argument('--station', help='NOAA station id (default: the configured one)')
+    parser.add_argument('--days', type=float, default=30, help='days to show, ending at the newest sample')
+    parser.add_argument('--out', default='tide_history.png', help='PNG to write')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    import tide_config
+    from tide_chart import TideChart
+
+    args = parse_args(argv)
+    config = tide_config.get()
+    archive = TideArchive(os.path.join(config.cache_path, 'archive'), args.station or config.noaa_station_id,
+                          raw_days=config.archive.get('raw_days', DEFAULT_RAW_DAYS))
+    span = archive.span()
+    if span is None:
+        raise SystemExit('The archive for this station is empty.')
+    end = span[1].astype(dt.datetime)
+    start = end - dt.timedelta(days=args.days)
+    chart = TideChart(title='Tide- Past {:g} Days'.format(args.days))
+    series = archive.read(start, end, chart.width)
+    chart.render(series.times.astype(dt.datetime), series.values - np.nanmin(series.values)).save(args.out)
+    print('{} points from {} to {} -> {}'.format(len(series.values), series.times[0], series.times[-1], args.out))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+'''
+Persistent tide chart.
+
+The matplotlib figure, axes and title are built once. Each render only
+replaces the vertices of the filled water-level polygon and the axis
+limits, draws through the Agg canvas and thresholds the RGBA buffer to a
+1-bit PIL image with NumPy, so there is no PNG encode/decode and no new
+figure per frame. The figure is not registered with pyplot, so the number
+of figures and the memory use stay flat however many frames are drawn.
+'''
+import matplotlib
+import matplotlib.dates as mdates
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from matplotlib.patches import Polygon
+from PIL import Image
+
+import dither
+
+RC = {
+    'font.size': 12,
+    'text.antialiased': False,
+}
+
+
+class TideChart:
+    def __init__(self, size=(12, 4), dpi=60, title='Tide- Past 24 Hours'):
+        self.width = int(size[0] * dpi)
+        self.height = int(size[1] * dpi)
+        with matplotlib.rc_context(RC):
+            self.figure = Figure(figsize=size, dpi=dpi)
+            self.canvas = FigureCanvasAgg(self.figure)
+            self.axes = self.figure.subplots()
+            self.axes.set_title(title, fontsize=20)
+            self.axes.xaxis_date()
+            self.fill = Polygon([[0, 0]], closed=True, facecolor='black', edgecolor='black',
+                                antialiased=False)
+            self.axes.add_patch(self.fill)
+
+    def render(self, times, levels):
+        """Draw the filled series and return the chart as a mode '1' image."""
+        x = mdates.date2num(times)
+        y = np.nan_to_num(levels, nan=0.0)  # gaps drop to the baseline
+        vertices = np.empty((len(x) + 2, 2))
+        vertices[1:-1, 0] = x
+        vertices[1:-1, 1] = y
+        vertices[0] = (x[0], 0.0)
+        vertices[-1] = (x[-1], 0.0)
+        self.fill.set_xy(vertices)
+
+        top = float(y.max()) if y.size else 1.0
+        self.axes.set_xlim(x[0], x[-1])
+        self.axes.set_ylim(0, top * 1.05 if top > 0 else 1.0)
+
+        with matplotlib.rc_context(RC):
+            self.canvas.draw()
+        # Antialiasing is off, so a threshold of the grey level is exact
+        rgba = np.asarray(self.canvas.buffer_rgba())
+        levels = rgba[..., :3].astype(np.uint16).sum(axis=2) // 3
+        return Image.fromarray(dither.threshold(levels))
@@ -0,0 +1,208 @@
+'''
+Configuration for the tide tracker.
+
+config.json is read once, validated and shared by every module through
+get(). A long-running process calls reload_if_changed() each cycle; when the
+file's mtime changes it is re-read and the listeners registered with
+on_change() are told which fields changed, so they can drop only the caches
+that depend on them.
+
+config.json can hold several display profiles under "displays". The values
+of the selected profile (TIDE_DISPLAY environment variable, or "display" in
+the file) override the top-level ones:
+
+    "display": "pier",
+    "displays": {
+        "pier": {"noaa_station_id": "8443970", "location_name": "Boston"}
+    }
+
+TIDE_CONFIG in the environment names another config file, and TIDE_CACHE_DIR
+overrides cache_dir for every profile.
+'''
+import dataclasses
+import json
+import logging
+import os
+from dataclasses import dataclass, field
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+script_dir = os.path.dirname(os.path.realpath(__file__))
+DEFAULT_PATH = os.environ.get('TIDE_CONFIG') or os.path.join(script_dir, 'config.json')
+
+# OpenWeather units and the labels we draw for them
+UNIT_LABELS = {
+    'imperial': (u'\N{DEGREE SIGN}F', 'MPH'),
+    'metric': (u'\N{DEGREE SIGN}C', 'm/s'),
+    'standard': ('K', 'm/s'),
+}
+
+
+class ConfigError(ValueError):
+    pass
+
+
+@dataclass(frozen=True)
+class Config:
+    latitude: float
+    longitude: float
+    location_name: str
+    noaa_station_id: str
+    openweather_api_key: str
+    units: str = 'imperial'
+    noaa_user_agent: str = ''
+    noaa_backend: str = 'json'
+    dry_run: bool = False
+    cache_dir: str = 'cache'
+    pipelined_refresh: bool = False
+    refresh_interval: float = 60
+    refresh_policy: dict = field(default_factory=dict)
+    api_quotas: dict = field(default_factory=dict)
+    fixtures: dict = field(default_factory=dict)
+    fetch_timeout: float = 10
+    stale_error_after: float = 6 * 3600
+    profile: bool = False
+    cadence: dict = field(default_factory=dict)
+    archive: dict = field(default_factory=dict)
+    dither: str = 'threshold'
+    bayer_size: int = 4
+    panels: list = field(default_factory=list)
+    panel_output: str = 'direct'
+    frame_shm: Optional[str] = None
+    remote_panel: Optional[str] = None
+    display: Optional[str] = None
+
+    @property
+    def cache_path(self):
+        return os.path.join(script_dir, self.cache_dir)
+
+    @property
+    def state_path(self):
+        """Where this display keeps its own state (refresh state, last frame,
+        snapshots, next wake-up). Profiles only share the API responses in
+        cache_path."""
+        if self.display:
+            return os.path.join(self.cache_path, self.display)
+        return self.cache_path
+
+    @property
+    def temp_unit(self):
+        return UNIT_LABELS[self.units][0]
+
+    @property
+    def speed_unit(self):
+        return UNIT_LABELS[self.units][1]
+
+
+REQUIRED = ('latitude', 'longitude', 'noaa_station_id', 'openweather_api_key')
+CHOICES = {
+    'units': tuple(UNIT_LABELS),
+    'noaa_backend': ('json', 'noaa_coops'),
+    'panel_output': ('direct', 'shm', 'remote'),
+    'dither': ('threshold', 'bayer', 'diffuse'),
+}
+
+
+def parse(raw, display=None):
+    """Build a validated Config from the parsed JSON, raising ConfigError
+    with every problem found."""
+    values = {k: v for k, v in raw.items() if k != 'displays'}
+    display = display or values.get('display')
+    if display:
+        displays = raw.get('displays', {})
+        if display not in displays:
+            raise ConfigError('unknown display profile {!r}'.format(display))
+        values.update(displays[display])
+        values['display'] = display
+
+    known = {f.name for f in dataclasses.fields(Config)}
+    unknown = sorted(set(values) - known)
+    if unknown:
+        logger.warning('Ignoring unknown config keys: %s', ', '.join(unknown))
+    # Empty strings in the template mean "not set"
+    values = {k: v for k, v in values.items() if k in known and v != ''}
+
+    problems = ['{} is required'.format(name) for name in REQUIRED if values.get(name) in (None, '')]
+    for name in ('latitude', 'longitude'):
+        try:
+            if name in values:
+                values[name] = float(values[name])
+        except (TypeError, ValueError):
+            problems.append('{} must be a number, got {!r}'.format(name, values[name]))
+    for name, choices in CHOICES.items():
+        if name in values and values[name] not in choices:
+            problems.append('{} must be one of {}, got {!r}'.format(name, ', '.join(choices), values[name]))
+    if values.get('bayer_size', 4) not in (2, 4, 8):
+        problems.append('bayer_size must be 2, 4 or 8, got {!r}'.format(values['bayer_size']))
+    if values.get('panel_output') == 'remote' and ':' not in str(values.get('remote_panel', '')):
+        problems.append('panel_output "remote" needs remote_panel as "host:port"')
+    for index, panel in enumerate(values.get('panels', [])):
+        for name in ('name', 'frame_shm'):
+            if name not in panel:
+                problems.append('panels[{}] needs a {!r}'.format(index, name))
+    if problems:
+        raise ConfigError('Invalid config: ' + '; '.join(problems))
+    values['noaa_station_id'] = str(values['noaa_station_id'])
+    values.setdefault('location_name', '')
+    if os.environ.get('TIDE_CACHE_DIR'):
+        values['cache_dir'] = os.environ['TIDE_CACHE_DIR']
+    return Config(**values)
+
+
+def load(path=DEFAULT_PATH):
+    with open(path, 'r') as configfile:
+        raw = json.load(configfile)
+    return parse(raw, os.environ.get('TIDE_DISPLAY'))
+
+
+def profiles(path=DEFAULT_PATH):
+    """Every display profile in config.json as {name: Config}; {None: Config}
+    when the file has no profiles."""
+    with open(path, 'r') as configfile:
+        raw = json.load(configfile)
+    names = list(raw.get('displays', {})) or [None]
+    return {name: parse(raw, name) for name in names}
+
+
+_path = DEFAULT_PATH
+_current = None
+_mtime = None
+_listeners = []
+
+
+def get():
+    """Return the shared Config, loading it on first use."""
+    global _current, _mtime
+    if _current is None:
+        _mtime = os.stat(_path).st_mtime
+        _current = load(_path)
+    return _current
+
+
+def on_change(listener):
+    """Register listener(old, new, changed_field_names), called after a reload."""
+    _listeners.append(listener)
+
+
+def reload_if_changed():
+    """Re-read config.json if it changed on disk. Returns the changed field names.
+    An invalid file is logged and the previous config kept."""
+    global _current, _mtime
+    old = get()
+    try:
+        mtime = os.stat(_path).st_mtime
+        if mtime == _mtime:
+            return set()
+        new = load(_path)
+    except (OSError, ValueError) as error:
+        logger.error('Not reloading config: %s', error)
+        return set()
+    _mtime = mtime
+    changed = {f.name for f in dataclasses.fields(Config) if getattr(old, f.name) != getattr(new, f.name)}
+    _current = new
+    if changed:
+        logger.info('Config reloaded; changed: %s', ', '.join(sorted(changed)))
+        for listener in _listeners:
+            listener(old, new, changed)
+    return changed
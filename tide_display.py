@@ -0,0 +1,353 @@
+'''
+Fetches the data and composes and writes the tide display.
+
+tide_tracker.py is the entry point and only imports this module (and with it
+NumPy, PIL, matplotlib and requests) once a refresh is actually due.
+'''
+import datetime as dt
+import functools
+import logging
+import os
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+import cadence
+import clock
+import decimate
+import dither
+import epd_frame
+import frame_codec
+import frame_shm
+import panel_driver
+import refresh_policy
+import snapshots
+from tide_chart import TideChart
+import tide_config
+import weather_model
+import weather_tides_api
+
+logger = logging.getLogger(__name__)
+
+picdir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'images')
+icondir = os.path.join(picdir, 'icon')
+fontdir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'font')
+
+refresh = refresh_policy.RefreshPolicy(tide_config.get().state_path, **tide_config.get().refresh_policy)
+snapshot_store = snapshots.SnapshotStore(tide_config.get().state_path)
+
+
+def config_changed(old, new, changed):
+    # Drop only the state whose inputs changed
+    global refresh, snapshot_store
+    if changed & {'frame_shm', 'cache_dir', 'display'}:
+        frame_writer.cache_clear()
+    if 'remote_panel' in changed:
+        frame_sender.cache_clear()
+    if changed & {'cache_dir', 'display', 'refresh_policy'}:
+        refresh = refresh_policy.RefreshPolicy(new.state_path, **new.refresh_policy)
+    if changed & {'cache_dir', 'display'}:
+        snapshot_store = snapshots.SnapshotStore(new.state_path)
+        return
+    if 'noaa_station_id' in changed or 'noaa_backend' in changed:
+        snapshot_store.invalidate('water_level', 'hilo')
+    if changed & {'latitude', 'longitude', 'units', 'openweather_api_key'}:
+        snapshot_store.invalidate('weather')
+
+tide_config.on_change(config_changed)
+
+
+def write_to_screen(image, epd):
+    print('Writing to screen.') # for debugging
+    config = tide_config.get()
+    h_image = dither.convert(image, config.dither, bayer_size=config.bayer_size)
+    if h_image.size != (epd.width, epd.height):
+        # Initialize the drawing context with template as background
+        canvas = Image.new('1', (epd.width, epd.height), 255)
+        canvas.paste(h_image, (0, 0))
+        h_image = canvas
+
+    frame = epd_frame.pack(h_image)
+    decision = refresh.decide(frame)
+    if decision.mode == refresh_policy.SKIP:
+        return
+
+    # Display Image
+    if config.dry_run:
+        h_image.show()
+    elif config.panel_output == 'shm':
+        # Hand the frame to the resident panel_driver.py process
+        rects = [(0, decision.rows[0], epd.width, decision.rows[1])] if decision.rows else []
+        frame_writer().publish(frame, decision.mode, rects)
+    elif config.panel_output == 'remote':
+        # Delta-encoded over TCP to panel_driver.py --listen on the remote host
+        try:
+            sent = frame_sender().send(frame, decision.mode)
+        except OSError as error:
+            logger.error('Could not send the frame to %s: %s', config.remote_panel, error)
+            return
+        logger.info('Sent %d bytes to %s', sent, config.remote_panel)
+    else:
+        panel_driver.push_frame(epd, decision.mode, frame, decision.rows)
+    refresh.record(decision, frame)
+
+
+@functools.lru_cache(maxsize=None)
+def frame_writer():
+    config = tide_config.get()
+    path = config.frame_shm or frame_shm.default_path(config.state_path, config.display)
+    return frame_shm.FrameWriter(path, epd_frame.FRAME_BYTES)
+
+
+@functools.lru_cache(maxsize=None)
+def frame_sender():
+    return frame_codec.FrameSender(tide_config.get().remote_panel)
+
+
+def render_error(error_source, epd):
+    print('Error in the', error_source, 'request.')
+    # Initialize drawing
+    error_image = Image.new('1', (epd.width, epd.height), 255)
+    # Initialize the drawing
+    draw = ImageDraw.Draw(error_image)
+    draw.fontmode = "1"
+    draw.text((100, 150), error_source +' ERROR', font=font(50), fill=black)
+    draw.text((100, 300), 'Retrying in 30 seconds', font=font(22), fill=black)
+    current_time = clock.now().strftime('%H:%M')
+    draw.text((300, 365), 'Last Refresh: ' + str(current_time), font=font(22), fill=black)
+    return error_image
+
+
+def display_error(error_source, epd):
+    error_image = render_error(error_source, epd)
+    # Write error to screen
+    write_to_screen(error_image, epd)
+    error_image.close()
+
+
+SOURCE_NAMES = {'weather': 'Weather', 'water_level': 'Tide Data', 'hilo': 'Tide Prediction'}
+
+
+def format_age(seconds):
+    if seconds < 3600:
+        return '{:.0f}m'.format(seconds // 60)
+    if seconds < 86400:
+        return '{:.0f}h'.format(seconds // 3600)
+    return '{:.0f}d'.format(seconds // 86400)
+
+
+# The chart is built once and only its data is updated on later frames
+tide_chart = None
+
+# Plot last 24 hours of tide
+def plotTide(TideData):
+    global tide_chart
+    if tide_chart is None:
+        tide_chart = TideChart(size=(12, 4), dpi=60)
+
+    # Adjust data for negative values
+    levels = TideData.values - np.nanmin(TideData.values)
+    # Never draw more points than the chart has pixel columns
+    times, levels = decimate.minmax(TideData.times, levels, tide_chart.width)
+    return tide_chart.render(times, levels)
+
+# Fonts and icons are loaded once and reused across frames
+@functools.lru_cache(maxsize=None)
+def font(size):
+    return ImageFont.load_default(size)
+
+
+@functools.lru_cache(maxsize=None)
+def load_icon(icon_file, size=(130, 130), method='threshold', bayer_size=4):
+    # Converted to 1-bit once, so pasting into the frame needs no implicit conversion
+    with Image.open(os.path.join(icondir, icon_file)) as icon_image:
+        return dither.convert(icon_image, method, size, bayer_size)
+
+
+# Set the colors
+black = 'rgb(0,0,0)'
+white = 'rgb(255,255,255)'
+grey = 'rgb(235,235,235)'
+
+class ForecastData:
+    def __init__(self, daily_forecast: weather_model.DailyForecast, temp_unit: str):
+        self.temp_min = daily_forecast.temp_min
+        self.temp_max = daily_forecast.temp_max
+        self.precip_percent = daily_forecast.pop * 100
+        self.icon_code = daily_forecast.icon
+
+        self.fmt_temp_min = 'Low: ' + format(self.temp_min, '>.0f') + temp_unit
+        self.fmt_temp_max = 'High:  ' + format(self.temp_max, '>.0f') + temp_unit
+        self.fmt_precip_percent = 'Precip: ' + str(format(self.precip_percent, '.0f'))  + '%'
+        self.fmt_icon_code = self.icon_code + '.png'
+
+
+def fetch_data():
+    # Fetch everything concurrently; sources that fail or are slow fall back
+    # to their last good snapshot so a bad upstream never blocks the frame.
+    return snapshot_store.get_all({
+        'weather': weather_tides_api.onecall,
+        'water_level': weather_tides_api.water_level_24h,
+        'hilo': weather_tides_api.tides,
+    }, timeout=tide_config.get().fetch_timeout)
+
+
+def render_frame(epd):
+    data = fetch_data()
+    schedule_next_refresh(data)
+    return compose_frame(epd, data)
+
+
+def schedule_next_refresh(data):
+    config = tide_config.get()
+    if cadence.settings(config.cadence)['enabled']:
+        retry = None
+        if failed_source(data):
+            retry = 'error'
+        elif not all(snapshot.fresh for snapshot in data.values()):
+            retry = 'stale'
+        cadence.schedule(config.state_path, data['water_level'].value, data['hilo'].value, config.cadence,
+                         retry=retry)
+
+
+def failed_source(data):
+    """Name of the first source with nothing recent enough to draw, or None."""
+    for name, snapshot in data.items():
+        if snapshot.value is None or snapshot.age > tide_config.get().stale_error_after:
+            return name
+    return None
+
+
+def compose_frame(epd, data):
+    config = tide_config.get()
+    failed = failed_source(data)
+    if failed:
+        return render_error(SOURCE_NAMES[failed], epd)
+    stale = [SOURCE_NAMES[name] + ' ' + format_age(snapshot.age)
+             for name, snapshot in data.items() if not snapshot.fresh]
+
+    onecall_result = data['weather'].value
+    # Get current weather conditions
+    current_conditions = onecall_result.current
+    temp_current = current_conditions.temp
+    feels_like = current_conditions.feels_like
+    humidity = current_conditions.humidity
+    wind = current_conditions.wind_speed
+    report = current_conditions.description
+    icon_code = current_conditions.icon
+
+    # get daily forecasts
+    daily = onecall_result.daily
+
+    today_forecast = ForecastData(daily[0], config.temp_unit)
+    nx_forecast = ForecastData(daily[1], config.temp_unit)
+    nx_nx_forecast = ForecastData(daily[2], config.temp_unit)
+
+    # Format current conditions data
+    string_temp_current = format(temp_current, '.0f') + config.temp_unit
+    string_feels_like = 'Feels like: ' + format(feels_like, '.0f') + config.temp_unit
+    # string_humidity = 'Humidity: ' + str(humidity) + '%'  # Never used originally
+    string_wind = 'Wind: ' + format(wind, '.1f') + ' ' + config.speed_unit
+    string_report = 'Now: ' + report.title()
+
+    # Last updated time: when the oldest stale source was fetched, or now
+    stale_age = max((snapshot.age for snapshot in data.values() if not snapshot.fresh), default=0)
+    updated = clock.now() - dt.timedelta(seconds=stale_age)
+    current_time = updated.strftime("%H:%M")
+    last_update_string = 'Last Updated: ' + current_time
+
+    # Tide Data
+    tide_graph = plotTide(data['water_level'].value)
+
+
+    # Open template file
+    template = Image.new('1', (epd.width, epd.height), 255)
+    # Initialize the drawing context with template as background
+    draw = ImageDraw.Draw(template)
+    draw.fontmode = "1"
+
+    # Current weather
+    ## Open icon file
+    icon_image = load_icon(icon_code + '.png', method=config.dither, bayer_size=config.bayer_size)
+    template.paste(icon_image, (50, 50))
+
+    draw.text((125,10), config.location_name, font=font(35), fill=black)
+
+    # Center current weather report
+    w = draw.textlength(string_report, font=font(20))
+    h = 20
+    #print(w)
+    if w > 250:
+        string_report = 'Now:\n' + report.title()
+
+    center = int(120-(w/2))
+    draw.text((center,175), string_report, font=font(20), fill=black)
+
+    # Data
+    draw.text((250,55), string_temp_current, font=font(35), fill=black)
+    y = 100
+    draw.text((250,y), string_feels_like, font=font(16), fill=black)
+    draw.text((250,y+20), string_wind, font=font(16), fill=black)
+    draw.text((250,y+40), today_forecast.fmt_precip_percent, font=font(16), fill=black)
+    draw.text((250,y+60), today_forecast.fmt_temp_max, font=font(16), fill=black)
+    draw.text((250,y+80), today_forecast.fmt_temp_min, font=font(16), fill=black)
+
+    draw.text((125,218), last_update_string, font=font(16), fill=black)
+
+    # Weather Forcast
+    # Tomorrow
+    icon_image = load_icon(nx_forecast.fmt_icon_code, method=config.dither, bayer_size=config.bayer_size)
+    template.paste(icon_image, (435, 50))
+    draw.text((450,20), 'Tomorrow', font=font(22), fill=black)
+    draw.text((415,180), nx_forecast.fmt_temp_max, font=font(16), fill=black)
+    draw.text((515,180), nx_forecast.fmt_temp_min, font=font(16), fill=black)
+    draw.text((460,200), nx_forecast.fmt_precip_percent, font=font(16), fill=black)
+
+    # Next Next Day Forcast
+    icon_image = load_icon(nx_nx_forecast.fmt_icon_code, method=config.dither, bayer_size=config.bayer_size)
+    template.paste(icon_image, (635, 50))
+    draw.text((625,20), 'Next-Next Day', font=font(22), fill=black)
+    draw.text((615,180), nx_nx_forecast.fmt_temp_max, font=font(16), fill=black)
+    draw.text((715,180), nx_nx_forecast.fmt_temp_min, font=font(16), fill=black)
+    draw.text((660,200), nx_nx_forecast.fmt_precip_percent, font=font(16), fill=black)
+
+
+    ## Dividing lines
+    draw.line((400,10,400,220), fill='black', width=3)
+    draw.line((600,20,600,210), fill='black', width=2)
+
+
+    # Tide Info
+    template.paste(tide_graph, (125, 240))
+
+    # Large horizontal dividing line
+    h = 240
+    draw.line((25, h, 775, h), fill='black', width=3)
+
+    # Daily tide times
+    draw.text((30,260), "Today's Tide", font=font(22), fill=black)
+
+    # Get tide time predictions
+    hilo_daily = data['hilo'].value
+
+    # Display tide preditions
+    y_loc = 300 # starting location of list
+    # Iterate over preditions
+    for event in hilo_daily:
+        tide_time = event['t'].astype(dt.datetime).strftime("%H:%M")
+        # For high tide
+        if event['type'] == 'H':
+            tidestr = "High: " + tide_time
+        # For low tide
+        elif event['type'] == 'L':
+            tidestr = "Low:  " + tide_time
+
+        # Draw to display image
+        draw.text((40,y_loc), tidestr, font=font(16), fill=black)
+        y_loc += 25 # This bumps the next prediction down a line
+
+    # Mark data that came from a snapshot instead of a fresh fetch
+    if stale:
+        draw.text((30, 455), 'Stale: ' + ', '.join(stale), font=font(14), fill=black)
+
+    return template
@@ -0,0 +1,81 @@
+'''
+Compact weather model for the One Call response.
+
+Only the fields the display draws are kept, in __slots__ classes. This is
+also the form that is cached and snapshotted, instead of the raw JSON with
+eight forecast days and every field OpenWeather sends.
+'''
+
+FORECAST_DAYS = 3  # today, tomorrow and the day after
+
+
+class CurrentWeather:
+    __slots__ = ('dt', 'temp', 'feels_like', 'humidity', 'wind_speed', 'description', 'icon')
+
+    def __init__(self, dt, temp, feels_like, humidity, wind_speed, description, icon):
+        self.dt = dt
+        self.temp = temp
+        self.feels_like = feels_like
+        self.humidity = humidity
+        self.wind_speed = wind_speed
+        self.description = description
+        self.icon = icon
+
+    @classmethod
+    def from_payload(cls, current):
+        weather = current['weather'][0]
+        return cls(current.get('dt'), current['temp'], current['feels_like'], current.get('humidity'),
+                   current['wind_speed'], weather['description'], weather['icon'])
+
+    def to_list(self):
+        return [getattr(self, name) for name in self.__slots__]
+
+    def __repr__(self):
+        return 'CurrentWeather({})'.format(', '.join('{}={!r}'.format(n, getattr(self, n)) for n in self.__slots__))
+
+
+class DailyForecast:
+    __slots__ = ('dt', 'temp_min', 'temp_max', 'pop', 'icon')
+
+    def __init__(self, dt, temp_min, temp_max, pop, icon):
+        self.dt = dt
+        self.temp_min = temp_min
+        self.temp_max = temp_max
+        self.pop = pop
+        self.icon = icon
+
+    @classmethod
+    def from_payload(cls, daily):
+        return cls(daily.get('dt'), daily['temp']['min'], daily['temp']['max'],
+                   daily.get('pop', 0), daily['weather'][0]['icon'])
+
+    def to_list(self):
+        return [getattr(self, name) for name in self.__slots__]
+
+    def __repr__(self):
+        return 'DailyForecast({})'.format(', '.join('{}={!r}'.format(n, getattr(self, n)) for n in self.__slots__))
+
+
+class Weather:
+    __slots__ = ('current', 'daily')
+
+    def __init__(self, current, daily):
+        self.current = current
+        self.daily = daily
+
+    @classmethod
+    def from_payload(cls, payload, days=FORECAST_DAYS):
+        """Pick the rendered fields out of a One Call response."""
+        return cls(CurrentWeather.from_payload(payload['current']),
+                   [DailyForecast.from_payload(day) for day in payload['daily'][:days]])
+
+    def to_dict(self):
+        """Compact JSON-able form used by the response cache."""
+        return {'current': self.current.to_list(), 'daily': [day.to_list() for day in self.daily]}
+
+    @classmethod
+    def from_dict(cls, compact):
+        return cls(CurrentWeather(*compact['current']), [DailyForecast(*day) for day in compact['daily']])
+
+    def __repr__(self):
+        return 'Weather(current={!r}, daily={!r})'.format(self.current, self.daily)
@@ -1,96 +1,181 @@
 import datetime as dt
-import json
+import logging
 import os
 import requests
 import time
 
 from pprint import pprint
-import noaa_coops
 
-configpath = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'config.json')
-
-with open(configpath, 'r') as configfile:
-    config = json.load(configfile)
-
-
-NOAA_COOPS_STATION = config.get('noaa_station_id')
-
-API_KEY = config.get('openweather_api_key')
-# Get LATITUDE and LONGITUDE of location
-LATITUDE = config.get('latitude')
-LONGITUDE = config.get('longitude')
-UNITS = config.get('units')  # 'imperial' for Fahrenheit, 'metric' for Celsius
-
-# Create URL for API call
-OPENWEATHER_ONECALL_URL = 'https://api.openweathermap.org/data/3.0/onecall?lat={lat}&lon={lon}&units={units}&exclude=minutely,hourly&appid={api_key}'
-
-def request_with_retries(url, retries=3, backoff_factor=0.3):
-    """Make a GET request with retries."""
+import api_budget
+import clock
+import fixtures
+import noaa_client
+import sources
+import tide_archive
+import tide_config
+import weather_model
+
+logger = logging.getLogger(__name__)
+
+script_dir = os.path.dirname(os.path.realpath(__file__))
+budget = api_budget.ApiBudget(tide_config.get().cache_path, tide_config.get().api_quotas)
+archive_dir = os.path.join(tide_config.get().cache_path, 'archive')
+fixtures.configure(tide_config.get().fixtures, script_dir)
+
+
+def config_changed(old, new, changed):
+    # Response caches are keyed by station/location/units, so only the
+    # budget and fixture settings need to follow a reload.
+    global budget, archive_dir
+    if changed & {'cache_dir', 'api_quotas'}:
+        budget = api_budget.ApiBudget(new.cache_path, new.api_quotas)
+    if 'cache_dir' in changed:
+        archive_dir = os.path.join(new.cache_path, 'archive')
+    if 'fixtures' in changed:
+        fixtures.configure(new.fixtures, script_dir)
+
+tide_config.on_change(config_changed)
+
+# Create URL for API call (only current conditions and the daily forecast are drawn)
+OPENWEATHER_ONECALL_URL = 'https://api.openweathermap.org/data/3.0/onecall?lat={lat}&lon={lon}&units={units}&exclude=minutely,hourly,alerts&appid={api_key}'
+
+# One session, so repeated calls to the same host reuse kept-alive connections
+session = requests.Session()
+
+def http_get(url, headers=None):
+    """GET url, or answer it from recorded fixtures in replay mode.
+
+    Each attempt is limited to fetch_timeout seconds, so a hung connection
+    can't hold its refresh thread, or the response cache lock, for ever."""
+    if fixtures.mode == 'replay':
+        return fixtures.replay(url)
+    response = session.get(url, headers=headers, timeout=tide_config.get().fetch_timeout)
+    if fixtures.mode == 'record':
+        fixtures.record(url, response)
+    return response
+
+def request_with_retries(url, retries=3, backoff_factor=0.3, headers=None, charge=None):
+    """Make a GET request with retries.
+
+    Only connection errors, 429 and 5xx responses are retried; a Retry-After
+    header is honoured. charge() is called before every attempt so each one
+    counts against the API budget."""
     for attempt in range(retries):
+        if charge is not None:
+            charge()
         try:
-            response = requests.get(url)
+            response = http_get(url, headers=headers)
             response.raise_for_status()
             return response
         except requests.RequestException as e:
+            status = e.response.status_code if e.response is not None else None
+            if status is not None and status != 429 and status < 500:
+                raise e  # client error, retrying won't help
             if attempt < retries - 1:
-                time.sleep(backoff_factor * (2 ** attempt))
+                delay = backoff_factor * (2 ** attempt)
+                retry_after = e.response.headers.get('Retry-After') if e.response is not None else None
+                if retry_after and retry_after.isdigit():
+                    delay = max(delay, int(retry_after))
+                time.sleep(delay)
             else:
                 raise e
 
-def onecall():
-    url = OPENWEATHER_ONECALL_URL.format(lat=LATITUDE, lon=LONGITUDE, units=UNITS, api_key=API_KEY)
-    response = request_with_retries(url)
-    return response.json()
+def onecall(latitude=None, longitude=None, units=None, api_key=None):
+    config = tide_config.get()
+    latitude = config.latitude if latitude is None else latitude
+    longitude = config.longitude if longitude is None else longitude
+    units = units or config.units
+    api_key = api_key or config.openweather_api_key
+    url = OPENWEATHER_ONECALL_URL.format(lat=latitude, lon=longitude, units=units, api_key=api_key)
+    cache_key = sources.weather_key(latitude, longitude, units)
+    # The compact model, not the raw response, is what gets cached
+    compact = budget.fetch(cache_key, 'openweather', api_key,
+                           lambda charge: weather_model.Weather.from_payload(
+                               request_with_retries(url, charge=charge).json()).to_dict(),
+                           min_interval=sources.WEATHER_MIN_INTERVAL)
+    return weather_model.Weather.from_dict(compact)
+
+def noaa_data(cache_key, min_interval, station, begin_date, end_date, product, interval=None):
+    user_agent = tide_config.get().noaa_user_agent
+    url = noaa_client.build_url(station, begin_date, end_date, product,
+                                interval=interval, application=user_agent)
+    headers = {'User-Agent': user_agent} if user_agent else None
+    return budget.fetch(cache_key, 'noaa', user_agent,
+                        lambda charge: request_with_retries(url, headers=headers, charge=charge).json(),
+                        min_interval=min_interval)
+
+def noaa_coops_data(station, begin_date, end_date, product, interval=None):
+    import noaa_coops  # optional, slow to import
+    kwargs = {'interval': interval} if interval else {}
+    return noaa_coops.Station(station).get_data(
+        begin_date=begin_date,
+        end_date=end_date,
+        product=product,
+        datum="MLLW",
+        time_zone="lst_ldt",
+        **kwargs)
 
-def water_level_24h():
-    stationdata = noaa_coops.Station(NOAA_COOPS_STATION)
-    today = dt.datetime.now()
+def water_level_24h(station=None):
+    station = station or tide_config.get().noaa_station_id
+    today = clock.now()
     todaystr = today.strftime("%Y%m%d %H:%M")
     yesterday = today - dt.timedelta(days=1)
     yesterdaystr = yesterday.strftime("%Y%m%d %H:%M")
 
     # Get water level data
-    WaterLevel = stationdata.get_data(
-        begin_date=yesterdaystr,
-        end_date=todaystr,
-        product="water_level",
-        datum="MLLW",
-        time_zone="lst_ldt")
-
-    return WaterLevel
-
-def tides():
-    stationdata = noaa_coops.Station(NOAA_COOPS_STATION)
-    today = dt.datetime.now()
+    # 'noaa_coops' uses the noaa_coops package (pandas) instead of the JSON client
+    if tide_config.get().noaa_backend == 'noaa_coops':
+        frame = noaa_coops_data(station, yesterdaystr, todaystr, "water_level")
+        series = noaa_client.series_from_dataframe(frame)
+    else:
+        payload = noaa_data(sources.water_level_key(station), sources.water_level_interval(clock.time()),
+                            station, yesterdaystr, todaystr, "water_level")
+        series = noaa_client.parse_series(payload)
+    archive_series(station, series)
+    return series
+
+def archive_series(station, series, product='water_level'):
+    """Add a fetched series to the station's history archive. A failure is
+    logged, it never stops the display from updating."""
+    settings = tide_config.get().archive
+    if not settings.get('enabled', True):
+        return
+    try:
+        tide_archive.TideArchive(archive_dir, station, product,
+                                 raw_days=settings.get('raw_days', tide_archive.DEFAULT_RAW_DAYS)).update(series)
+    except OSError as error:
+        logger.error('Could not archive %s for station %s: %s', product, station, error)
+
+def tides(station=None):
+    station = station or tide_config.get().noaa_station_id
+    today = clock.now()
     todaystr = today.strftime("%Y%m%d")
     tomorrow = today + dt.timedelta(days=1)
     tomorrowstr = tomorrow.strftime("%Y%m%d")
 
     # Get Hi and Lo Tide info
-    TideHiLo = stationdata.get_data(
-        begin_date=todaystr,
-        end_date=tomorrowstr,
-        product="predictions",
-        datum="MLLW",
-        interval="hilo",
-        time_zone="lst_ldt")
-
-    return TideHiLo
+    # 'noaa_coops' uses the noaa_coops package (pandas) instead of the JSON client
+    if tide_config.get().noaa_backend == 'noaa_coops':
+        frame = noaa_coops_data(station, todaystr, tomorrowstr, "predictions", interval="hilo")
+        return noaa_client.hilo_from_dataframe(frame)
+    payload = noaa_data(sources.hilo_key(station, today), sources.HILO_MIN_INTERVAL,
+                        station, todaystr, tomorrowstr, "predictions", interval="hilo")
+    return noaa_client.parse_hilo(payload)
 
 def main():
     # Running this file directly will print out current weather and tide data
     onecall_result = onecall()
     print("Current Weather:")
-    pprint(onecall_result.get('current'))
+    pprint(onecall_result.current)
 
     print("\nForecast:")
-    pprint(onecall_result.get('daily')[0:2]) # Print today's and tomorrow's forecast
+    pprint(onecall_result.daily[0:2]) # Print today's and tomorrow's forecast
 
-    water_level = water_level_24h(NOAA_COOPS_STATION)
+    water_level = water_level_24h()
     print("\nWater Level (Last 24 hours):")
     pprint(water_level)
     
-    tide = tides(NOAA_COOPS_STATION)
+    tide = tides()
     print("\nTide Data:")
     pprint(tide)
 